@@ -21,13 +21,17 @@
 #    Port 2+ --> Client hosts
 #       MAC: 00:01:02:03:22:[xx]
 # Host r[d] = Replica servers
-#    IP: 10.1.0.[d + 1]
+#    IP: 10.1.0.[d + 1], skipping the dummy IP 10.1.0.100 (see shard.py)
 #    MAC: 00:01:02:03:01:[xx]
 # Host c[d] = Client hosts
 #    IP: 10.2.0.[d + 1]
 #    MAC: 00:01:02:03:02:[xx]
 #
 # NOTE: IPs of client client hosts are subject to change during tests.
+#
+# With -L for several LB switches, or more than 250 servers or clients,
+# hosts spill into further /24s and switches are added following the
+# sharded layout in shard.py. The defaults give exactly the above.
 # ---------------------------------------------------------------------
 
 
@@ -42,6 +46,11 @@ Sets up the test harness for load balancer applications.
 -I, --dummy-ip    = IP of server array 'revealed' to clients
 -n, --num-tests   = Number of tests to run
 -d, --delay       = Number of seconds to wait before first test
+-r, --rate        = Per-client request rate of the open-loop load generator
+-T, --duration    = Seconds of load generator arrivals
+-k, --concurrency = Requests in flight per load generator
+-s, --service-times = Extra seconds per request of each replica server
+-L, --num-lbs     = Number of LB switches sharing the client space
 
 """
 
@@ -58,6 +67,8 @@ from mininet.cli import CLI
 from mininet.term import *
 import time
 import random
+from loadgen import sourceIPs
+from shard import *
 
 START_TIME = 0
 STATIC_ARP = True
@@ -67,9 +78,12 @@ switchTypes = {'us' : UserSwitch, 'ovsk' : OVSKernelSwitch}
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 # Creates the network topology from scratch
 # Uses the Mininet API to control MAC and IP at creation
-def createNetwork(net, numserv, numclient):
+# With numlb LB switches and more than 250 servers, follows the sharded
+# layout described in shard.py; the defaults give the three switches above.
+def createNetwork(net, numserv, numclient, numlb=1):
 
 #    cli = open('LB.cli', 'w')
+    numsub = num_subnets(numserv)
 
     print "Adding controller..."
     net.addController('c0')
@@ -79,38 +93,46 @@ def createNetwork(net, numserv, numclient):
     for i in range(1, numclient + 1):
         # Start IP addresses at *.*.*.2
         name = 'c' + str(i)
-        c.append(net.addHost(name, ip='10.2.0.' + str(i+1)))
+        c.append(net.addHost(name, ip=client_ip(i)))
 
     print "Adding replica servers..."
     r = [None]
     for i in range(1, numserv + 1):
-        # Start IP addresses at *.*.*.2
+        # Start IP addresses at *.*.*.2, server i is server i + 1 to the controller
         name = 'r' + str(i)
-        r.append(net.addHost(name, ip='10.1.0.' + str(i+1)))
+        r.append(net.addHost(name, ip=server_ip(i + 1)))
 
     print "Adding switches..."
-    s = []
-    s.append(net.addSwitch('s0', mac='00:00:00:00:00:80')) # Will be the Load Balancer
-    s.append(net.addSwitch('s1', mac='00:00:00:00:00:81', ip='10.1.0.1')) # Server side
-    s.append(net.addSwitch('s2', mac='00:00:00:00:00:82', ip='10.2.0.1')) # Client side
+    lbs = []
+    servsw = []
+    lbs.append(net.addSwitch('s0', mac=switch_mac(lb_dpid(0)))) # Will be the Load Balancer
+    servsw.append(net.addSwitch('s1', mac=switch_mac(server_switch_dpid(0)), ip='10.1.0.1')) # Server side
+    clientsw = net.addSwitch('s2', mac=switch_mac(CLIENT_DPID), ip='10.2.0.1') # Client side
+    for j in range(1, numlb):
+        lbs.append(net.addSwitch('s%d' % (2 + j,), mac=switch_mac(lb_dpid(j))))
+    for k in range(1, numsub):
+        servsw.append(net.addSwitch('s%d' % (1 + numlb + k,), mac=switch_mac(server_switch_dpid(k)), ip='10.1.%d.1' % (k,)))
 
     print "Joining switches and hosts..."
-    s[0].linkTo(s[1], port1=1, port2=1)
-    s[0].linkTo(s[2], port1=2, port2=1)
+    for j in range(numlb):
+        for k in range(numsub):
+            lbs[j].linkTo(servsw[k], port1=1 + k, port2=1 + j)
+        lbs[j].linkTo(clientsw, port1=numsub + 1, port2=1 + j)
 
     for i in range(1, len(r)):
         rep = r[i]
-        intf1, intf2 = rep.linkTo(s[1])
-        rep.setMAC(intf1, '00:01:02:03:01:%02x' % (i,))
-        s[1].setMAC(intf2, '00:01:02:03:11:%02x' % (i,))
+        sw = servsw[server_slot(i + 1)[0]]
+        intf1, intf2 = rep.linkTo(sw, port2=server_port(i + 1, numlb))
+        rep.setMAC(intf1, server_mac(i + 1))
+        sw.setMAC(intf2, server_gateway_mac(i + 1))
 #        cli.write('r%d arp -s 10.1.0.1 00:01:02:03:11:%02d\n' % (i,i))
 #        cli.write('%s ifconfig %s-eth0 10.1.0.%d/24\n' % (name, name, i+1))
 #        cli.write('%s route add default gw 10.1.0.1\n' % (name,))
     for i in range(1, len(c)):
         client = c[i]
-        intf1, intf2 = client.linkTo(s[2])
-        client.setMAC(intf1, '00:01:02:03:02:%02x' % (i,))
-        s[2].setMAC(intf2, '00:01:02:03:22:%02x' % (i,))
+        intf1, intf2 = client.linkTo(clientsw, port2=numlb + i)
+        client.setMAC(intf1, client_mac(i))
+        clientsw.setMAC(intf2, client_gateway_mac(i))
 #        cli.write('c%d arp -s 10.2.0.1 00:01:02:03:22:%02d\n' % (i,i))
 #    cli.close()
 
@@ -124,20 +146,20 @@ def configure(net):
     # Replica servers
     reps = [x for x in net.hosts if x.name[0] == 'r']
     for rep in reps:
-        i = int(rep.name[1:])
+        server = int(rep.name[1:]) + 1
         intf = rep.name + '-eth0'
-        rep.setIP(intf, '10.1.0.%d' % (i+1,), 24)
-        rep.cmd('route add default gw 10.1.0.1')
-        rep.setARP('10.1.0.1', '00:01:02:03:11:%02x' %(i,))
+        rep.setIP(intf, server_ip(server), 24)
+        rep.cmd('route add default gw ' + server_gateway(server))
+        rep.setARP(server_gateway(server), server_gateway_mac(server))
 
     # Clients
     clis = [x for x in net.hosts if x.name[0] == 'c']
     for cli in clis:
         i = int(cli.name[1:])
         intf = cli.name + '-eth0'
-        cli.setIP(intf, '10.2.0.%d' % (i+1,), 16)
+        cli.setIP(intf, client_ip(i), 16)
         cli.cmd('route add default gw 10.2.0.1')
-        cli.setARP('10.2.0.1', '00:01:02:03:22:%02x' %(i,))
+        cli.setARP('10.2.0.1', client_gateway_mac(i))
 
     return net
 
@@ -155,7 +177,22 @@ def intraServerPing(net, cliName):
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-def runServers(net):
+# Starts replica.py on every server, writing its request totals to
+# replica[id].json. serviceTimes optionally gives the extra seconds per
+# request of each server in order, to emulate unequal capacity.
+def runServers(net, serviceTimes=None):
+    reps = [x for x in net.hosts if x.name[0] == 'r']
+
+    print 'Starting up servers...'
+    for rep in reps:
+        i = int(rep.name[1:])
+        serviceTime = 0.0
+        if serviceTimes:
+            serviceTime = serviceTimes[(i - 1) % len(serviceTimes)]
+        rep.sendCmd('python replica.py -i %d -p 8080 -t %f -o replica%d.json &' % (i + 1, serviceTime, i + 1))
+
+# The old mongoose replicas, which only keep an error log
+def runMongooseServers(net):
     reps = [x for x in net.hosts if x.name[0] == 'r']
 
     print 'Starting up servers...'
@@ -210,9 +247,32 @@ def runRandomClients(net, dummyIP='10.1.0.100', numtests=10, delay=9):
             print 'Client %d has finished' % (i,)
             sys.exit(0)
 
+# Runs loadgen.py on every client for duration seconds of open-loop
+# arrivals at rate requests/s per client. Each client sends from
+# numsources addresses in 10.2.0.0/16, added as aliases on its interface,
+# and writes its latency results to loadgen-c[dd].json.
+def runLoadClients(net, dummyIP='10.1.0.100', rate=50.0, duration=30, concurrency=32, numsources=16, delay=9):
+    clients = [x for x in net.hosts if x.name[0] == 'c']
+    url = 'http://%s:8080/ServerData/dummyfile' % (dummyIP,)
+
+    # Disjoint source pools, clear of the clients' own addresses
+    own = set([client_ip(int(client.name[1:])) for client in clients])
+    pool = [ip for ip in sourceIPs(numsources * len(clients) + len(own), '10.2.0.0/16', seed=0)
+            if ip not in own]
+
+    print 'Starting load generators...'
+    time.sleep(delay)
+    for (k, client) in enumerate(clients):
+        i = int(client.name[1:])
+        sources = pool[k * numsources:(k + 1) * numsources]
+        for ip in sources:
+            client.cmd('ip addr add %s/16 dev %s-eth0' % (ip, client.name))
+        client.sendCmd('python loadgen.py -u %s -r %f -T %d -k %d -A %s -S %d -o loadgen-c%02d.json' % (
+            url, rate, duration, concurrency, ','.join(sources), i, i))
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-def start(stype, ip, port, numserv, numclient, dummyIP, numtests, delay):
+def start(stype, ip, port, numserv, numclient, dummyIP, numtests, delay, rate=None, duration=30, concurrency=32, serviceTimes=None, numlb=1):
 
     app='FreneticApp'
 
@@ -221,7 +281,7 @@ def start(stype, ip, port, numserv, numclient, dummyIP, numtests, delay):
                         controller=lambda name: RemoteController(name, defaultIP=ip, port=int(port)),
                         xterms=False )
     print "Creating topology..."
-    net = createNetwork(net, numserv, numclient)
+    net = createNetwork(net, numserv, numclient, numlb)
 
     print "Starting network..."
     net.start()
@@ -261,12 +321,12 @@ def start(stype, ip, port, numserv, numclient, dummyIP, numtests, delay):
 #    time.sleep(3) # Wait for controller to register
 #    print 'Running intra-server pings...'
 #    intraServerPing(net)
-    print 'Start mongoose servers? [Y (default) / n ] ',
+    print 'Start replica servers? [Y (default) / n ] ',
     l = sys.stdin.readline().strip()
     if l in no:
-        print 'Not running mongoose servers'
+        print 'Not running replica servers'
     elif l in yes:
-        runServers(net)
+        runServers(net, serviceTimes)
     else:
         print 'Unknown answer: ', l
         sys.exit(0)
@@ -280,6 +340,8 @@ def start(stype, ip, port, numserv, numclient, dummyIP, numtests, delay):
     if l in no:
         print 'Not running automatic client wgets'
 #        CLI(net, script=CLIfile)
+    elif l in yes and rate is not None:
+        runLoadClients(net, dummyIP=dummyIP, rate=rate, duration=duration, concurrency=concurrency, delay=delay)
     elif l in yes:
 #        CLI(net, script=CLIfile)
         print 'Randomize client IPs? [Y (default) / n ] ',
@@ -363,7 +425,7 @@ if __name__ == '__main__':
     # SIDE EFFECT: CLI interactive output is supressed as well.
     # SOLUTION: Change verbosity before launching CLI
     lg.setLogLevel( 'output')
-    MAXHOSTS = 100
+    MAXHOSTS = SERVERS_PER_SUBNET * 250 # Subnets 10.*.0 to 10.*.249
 
     usage = "Usage: %prog [options]"
     parser = OptionParser(usage=usage)
@@ -386,6 +448,16 @@ if __name__ == '__main__':
                         help="Number of wget tests to run per client.")
     parser.add_option('-d', '--delay', action='store', type='int', dest='delay', default=9,
                         help='Number of seconds to wait before first wget request from client.')
+    parser.add_option('-r', '--rate', action='store', type='float', dest='rate', default=None,
+                        help='Run open-loop load generators at this many requests/s per client instead of wget.')
+    parser.add_option('-T', '--duration', action='store', type='int', dest='duration', default=30,
+                        help='Seconds of load generator arrivals.')
+    parser.add_option('-L', '--num-lbs', action='store', type='int', dest='numlbs', default=1,
+                        help='Number of LB switches, each handling a shard of the client space.')
+    parser.add_option('-s', '--service-times', action='store', type='string', dest='serviceTimes', default='',
+                        help='Comma-separated extra seconds per request of each replica server, repeating.')
+    parser.add_option('-k', '--concurrency', action='store', type='int', dest='concurrency', default=32,
+                        help='Requests in flight at most per load generator.')
 
     (options, args) = parser.parse_args()
 
@@ -400,7 +472,9 @@ if __name__ == '__main__':
     START_TIME = time.time()
     STATIC_ARP = options.full_arp
     DEBUG = options.debug
-    start(options.st, ip, port, options.numservers, options.numclients, options.dummyIP, options.numtests, options.delay)
+    start(options.st, ip, port, options.numservers, options.numclients, options.dummyIP, options.numtests, options.delay,
+          options.rate, options.duration, options.concurrency,
+          [float(t) for t in options.serviceTimes.split(',') if t], options.numlbs)
 
 
 
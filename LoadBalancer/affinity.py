@@ -0,0 +1,139 @@
+import time
+from collections import OrderedDict
+from help_lb import *
+
+# Connection affinity for prefix migration. When a prefix moves to a new
+# server, clients seen recently behind it are pinned to their old server
+# with exact-match rules until they go idle, so only new clients follow
+# the new rule. A client is seen whenever it shows up in the periodic
+# per-client packet counts, not just at its first packet, so clients
+# that keep sending stay tracked and pinned.
+
+class ConnectionTable:
+    '''
+    Bounded table of client --> (server, last seen), least recently seen
+    first. Entries expire after idle_timeout seconds (never if None) and
+    the oldest entry is evicted once capacity is reached. Keys and
+    values can be anything hashable, so it also serves as the learned
+    host table.
+    '''
+
+    def __init__(self, capacity=4096, idle_timeout=30.0):
+        self.capacity = capacity
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return ip in self.entries
+
+    def get(self, ip):
+        return self.entries[ip][0]
+
+    def ips(self):
+        return self.entries.keys()
+
+    def items(self):
+        return [(ip, entry[0]) for (ip, entry) in self.entries.items()]
+
+    # Records activity of ip towards server. Returns the (ip, server)
+    # entries evicted to make room.
+    def touch(self, ip, server, now=None):
+        if now is None:
+            now = time.time()
+        if ip in self.entries:
+            del self.entries[ip]
+        self.entries[ip] = (server, now)
+
+        evicted = []
+        while len(self.entries) > self.capacity:
+            (old, (old_server, seen)) = self.entries.popitem(last=False)
+            evicted.append((old, old_server))
+        return evicted
+
+    # Drops entries idle for longer than idle_timeout, returning them
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        expired = []
+        while len(self.entries) > 0 and self.idle_timeout is not None:
+            (ip, (server, seen)) = next(self.entries.iteritems())
+            if now - seen <= self.idle_timeout:
+                break
+            del self.entries[ip]
+            expired.append((ip, server))
+        return expired
+
+# Whether the address ip (int) falls in an integer prefix of space
+def prefix_contains(prefix, length, ip, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    shift = 32 - int(base_len) - length
+    return (ip >> shift) == ((ip_to_int(base) >> shift) | prefix)
+
+# Tracked clients whose server differs between two prefix sets, as
+# (ip, old server) pins
+def migration_pins(connections, old_prefixes, new_prefixes, space='0.0.0.0/0'):
+    ips = sorted(connections.ips())
+    if len(ips) == 0:
+        return []
+    old = prefix_lookup(old_prefixes, ips, space)
+    new = prefix_lookup(new_prefixes, ips, space)
+    return [(ip, o) for (ip, o, n) in zip(ips, old, new) if o != n]
+
+# Records activity of client ip: refreshes its pin if it has one, and
+# otherwise its connection to its server under prefixes. Returns the
+# (ip, server) pins that have gone idle.
+def note_activity(ip, connections, pins, prefixes, space='0.0.0.0/0', now=None):
+    if ip in pins:
+        pins.touch(ip, pins.get(ip), now)
+    elif len(prefixes) > 0:
+        connections.touch(ip, prefix_lookup(prefixes, [ip], space)[0], now)
+    connections.expire(now)
+    return pins.expire(now)
+
+# Pins the tracked clients whose server changes from old_prefixes to
+# new_prefixes. Returns (new pins, released pins), the released ones
+# being those gone idle and those evicted to make room.
+def pin_migrations(connections, pins, old_prefixes, new_prefixes, space='0.0.0.0/0', now=None):
+    connections.expire(now)
+    released = pins.expire(now)
+    pinned = migration_pins(connections, old_prefixes, new_prefixes, space)
+    for (ip, server) in pinned:
+        released += pins.touch(ip, server, now)
+    return (pinned, released)
+
+# A client sending every poll interval from t=0 to t=120 keeps its
+# server across a migration at t=45, well past the 30s idle timeout,
+# and is released once it has been idle that long.
+def test_affinity(interval=10):
+    space = '10.2.0.0/16'
+    (connections, pins) = (ConnectionTable(16, 30.0), ConnectionTable(16, 30.0))
+    (old, new) = ([(0, 1, 2), (1, 1, 3)], [(0, 1, 3), (1, 1, 2)])
+    ip = ip_to_int('10.2.1.1')
+    for t in range(0, 45, interval):
+        assert note_activity(ip, connections, pins, old, space, t) == []
+    (pinned, released) = pin_migrations(connections, pins, old, new, space, 45)
+    assert pinned == [(ip, 2)] and released == [], (pinned, released)
+    for t in range(50, 121, interval):
+        assert note_activity(ip, connections, pins, new, space, t) == []
+        assert pins.get(ip) == 2
+    assert note_activity(ip_to_int('10.2.200.1'), connections, pins, new, space, 150) == []
+    assert note_activity(ip_to_int('10.2.200.1'), connections, pins, new, space, 151) == [(ip, 2)]
+    print 'ok'
+
+# Without an idle timeout only capacity bounds the table: every touch
+# that inserts past it, as both of param_lb's learned host paths do,
+# hands back the least recently seen entry
+def test_capacity():
+    hosts = ConnectionTable(capacity=2, idle_timeout=None)
+    assert hosts.touch((1, 'a'), 'p', 0) == [] and hosts.touch((2, 'a'), 'q', 1) == []
+    assert hosts.touch((1, 'a'), 'p', 2) == [] # Refreshing is not inserting
+    assert hosts.touch((2, 'b'), 'r', 3) == [((2, 'a'), 'q')]
+    assert hosts.expire(10 ** 9) == [] and len(hosts) == 2
+    print 'ok'
+
+if __name__ == '__main__':
+    test_affinity()
+    test_capacity()
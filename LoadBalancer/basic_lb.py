@@ -37,12 +37,15 @@ from nox.lib.packet.packet_utils import *
 from nox.lib.packet.ethernet import ethernet
 from nox.lib.packet.arp import arp
 from arpd import extractARP, extractARPType, extractRequest, extractReply
+from help_lb import *
+import instrument
 
 # INITIALLY FLOOD EVERYWHERE AND NEVER FWD
 flood_policy = Pol(PredTop(),[Action([],[openflow.OFPP_FLOOD])])
 fwd_policy = BottomPolicy()
 
 # Cleans up fwd and flood policies by walking them
+@instrument.timed('clean')
 def clean((fwd_policy, flood_policy)):
     fwd_policy = fwd_policy.walk(NV_parsePolUnion())
     flood_policy = flood_policy.walk(NV_parsePolUnion())
@@ -51,30 +54,30 @@ def clean((fwd_policy, flood_policy)):
 # Used to initialize a dumb middle switch that simply passes
 # all messages out the other port
 def initialize_Dumb_LB((fwd_policy, flood_policy)):
+    policy = PolicyBuilder()
     pred = Pred('switch', 128) & Pred('inport', 1)
     action = Action([], [2])
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    policy.add(pred, p)
 
     pred = Pred('switch', 128) & Pred('inport', 2)
     action = Action([], [1])
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    policy.add(pred, p)
 
-    return clean((fwd_policy, flood_policy))
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Load Balancer Logic
+@instrument.timed('initialize_LB')
 def initialize_LB((fwd_policy, flood_policy), num_servers=2, num_clients=4, dummy_ip='10.0.1.100'):
+    policy = PolicyBuilder()
 
     # Modify flows going from servers towards clients
     pred = Pred('switch', 128) & Pred('srcip','10.0.1.0/24') & Pred('dstip','10.0.2.0/24') # Allows for 255 servers
     mods = [Mod('srcip', dummy_ip)]
     action = Action(mods, [2])
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    policy.add(pred, p)
 
     # Known Client IPs
     # Start at IP 10.0.2.2
@@ -92,43 +95,42 @@ def initialize_LB((fwd_policy, flood_policy), num_servers=2, num_clients=4, dumm
         p = Pol(pred,[action])
 
         print "adjustPolicy %s, %s, %s" % (128, ip, p)
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        policy.add(pred, p)
 
-    return clean((fwd_policy,flood_policy))
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Logic of Client Gateway
 def setClientGateway((fwd_policy, flood_policy)):
+    policy = PolicyBuilder()
     # Match client -> servers
     pred = Pred('switch', 130) & Pred('dstip', '10.0.1.0/24')
     action = Action([], [1]) # Send to Load Balancer
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
-    return clean((fwd_policy, flood_policy))
+    policy.add(pred, p)
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Logic of Server Gateway
 def setServerGateway((fwd_policy, flood_policy)):
+    policy = PolicyBuilder()
     # Match server -> client
     pred = Pred('switch', 129) & Pred('dstip', '10.0.2.0/24')
     action = Action([], [1]) # Send to Load Balancer
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
-    return clean((fwd_policy, flood_policy))
+    policy.add(pred, p)
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 
 # LEARNING SWITCH LOGIC
 # d : IP --> (mac, port)
 d = {}
+@instrument.timed('adjustPolicy')
 def adjustPolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
     global d
+    policy = PolicyBuilder()
+    instrument.packet_in(switch, packet.header.inport, packet)
     if switch == 128: # Load Balancer shouldn't learn
         return (fwd_policy, flood_policy)
 
-    print "!!!! Following packet at switch %d, from port %s" % (switch, packet.header.inport)
-    print packet
-
 #    pred = Pred('switch',switch) & Pred('dstmac',mac)
 #    action = Action([],[packet.header.inport])
 #    p = Pol(pred,[action])
@@ -156,8 +158,7 @@ def adjustPolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
         mods = [Mod('dstmac', mac)]
         action = Action(mods, [packet.header.inport])
         p = Pol(pred, [action])
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        policy.add(pred, p)
 
 
 #    # Add IP learning
@@ -177,7 +178,7 @@ def adjustPolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
 #    print "post-fwd_policy:\n%s" % fwd_policy
 #    print "post-flood_policy:\n%s" % flood_policy
 #    print "---- end adjustPolicy --------"
-    return clean((fwd_policy,flood_policy))
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # rules : unit -> E policy
 rules_e = None
@@ -1,7 +1,23 @@
 
 import sys
+import math
+import numbers
+import bisect
+import numpy as np
+import instrument
+
+# Smallest power of 2 that is at least total
+def next_power(total):
+    a = 1
+    while a < total:
+        a *= 2
+    return a
 
 # Normalizes the entries of seq to sum to a power of 2
+# Uses largest-remainder apportionment: every entry gets the floor of its
+# exact share and the leftover units go to the largest remainders (ties
+# to the lowest index). Integer arithmetic for integer weights, O(n log n);
+# fractional weights such as measured rates take float shares instead.
 def normalize(seq, t=None):
 
     total = sum(seq)
@@ -10,51 +26,65 @@ def normalize(seq, t=None):
     if t is not None:
         a = t
     else: # Default to a power of 2
-        a = 1
-        while a < total:
-            a *= 2
+        a = next_power(total)
 
-    # No need to change if already sums to power of 2
-    if a == total:
+    # No need to change whole counts that already sum to power of 2
+    integral = all([isinstance(i, numbers.Integral) for i in seq])
+    if integral and a == total:
         return seq
 
     # Inflates seq so it totals a
-    f = [float(i) * a  / total for i in seq]
-    r = [int(round(i)) for i in f]
-    if sum(r) == a:
+    if integral:
+        shares = [divmod(i * a, total) for i in seq]
+    else:
+        exact = [float(i) * a / total for i in seq]
+        shares = [(int(math.floor(x)), x - math.floor(x)) for x in exact]
+    r = [q for (q, rem) in shares]
+    short = int(round(a - sum(r)))
+    if short == 0:
         return r
 
-    diffs = [ x[0] - x[1] for x in zip(f, r) ]
-
-    # Helper function since cmp requires an integer return value
-    def comp(x, y):
-        if y[1] - x[1] < 0:
-            return -1
-        elif y[1] - x[1] > 0:
-            return 1
-        else:
-            return 0
-
-    if a - sum(r) > 0: # Need to add
-        enum = enumerate(diffs)
-        toSort = [(e[1], e[0]) for e in enum]
-        s = sorted(toSort)
-        i = 0
-        while sum(r) < a:
-            index = s[i % len(s)][1]
-            r[index] += 1
-            i += 1
-    else: # Need to subtract
-        enum = enumerate(diffs)
-        toSort = [(e[1], e[0]) for e in enum]
-        s = sorted(toSort)
-        i = 0
-        while sum(r) > a:
-            index = s[i % len(s)][1]
-            r[index] -= 1
-            i += 1
+    order = sorted(range(len(seq)), key=lambda i: -shares[i][1])
+    for i in order[:short]:
+        r[i] += 1
     return r
 
+# Largest relative deviation of r's shares from seq's shares
+def max_relative_error(seq, r):
+    total = float(sum(seq))
+    a = float(sum(r))
+    errors = [abs(x / a - s / total) / (s / total) for (s, x) in zip(seq, r) if s > 0]
+    if len(errors) == 0:
+        return 0.0
+    return max(errors)
+
+# normalize over each row of a 2D array of loads at once, for what-if
+# planning. Returns (normalized rows, max relative error of each row).
+def normalize_batch(seqs, t=None):
+    seqs = np.asarray(seqs, dtype=np.int64)
+    totals = seqs.sum(axis=1)
+    if t is not None:
+        a = np.full(len(seqs), t, dtype=np.int64)
+    else:
+        a = np.array([next_power(total) for total in totals], dtype=np.int64)
+
+    scaled = seqs * a[:, None]
+    r = scaled // totals[:, None]
+    rems = scaled % totals[:, None]
+    short = a - r.sum(axis=1)
+
+    # Rank of each remainder within its row, largest first
+    order = np.argsort(-rems, axis=1, kind='mergesort')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(seqs.shape[1])[None, :], axis=1)
+    r += ranks < short[:, None]
+
+    want = seqs / totals[:, None].astype(float)
+    got = r / a[:, None].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors = np.where(seqs > 0, np.abs(got - want) / want, 0.0)
+    return (r, errors.max(axis=1))
+
 # Takes list of (weight, server, binary weight) tuples and creates
 # the appropriate list of nodes to allocate
 # (weight, server, bin. weight) --> (weight, server, pow)
@@ -106,6 +136,384 @@ def nodes_to_rules(total_weight, nodes):
         cum_sum += n[0]
     return rules
 
+# Number of prefix rules weights_to_prefixes emits for loads
+def rule_count(loads):
+    return sum([bin(w).count('1') for w in loads])
+
+# Value with the fewest set bits in [lo, hi]: the common high bits of lo
+# and hi followed by a 1 where they first differ, unless lo is already
+# those common bits followed by zeros
+def fewest_bits(lo, hi):
+    if lo >= hi:
+        return lo
+    top = 1 << ((lo ^ hi).bit_length() - 1)
+    if lo & (2 * top - 1) == 0:
+        return lo
+    return (hi & ~(2 * top - 1)) | top
+
+# Apportions loads over 2^power addresses with every server within a
+# relative error of error, preferring values with few set bits (few
+# rules). Greedy: start each server at its fewest-bits value, then close
+# the gap to 2^power with the largest power of 2 steps that still fit.
+# Returns None if the intervals cannot reach 2^power. With live, no
+# server with load is cut to 0 even when error allows it.
+def fit_loads(loads, power, error, live=False):
+    total = float(sum(loads))
+    a = 2 ** power
+    bounds = []
+    for l in loads:
+        x = l * a / total
+        lo = int(math.ceil(x * (1 - error) - 1e-9))
+        if live and l > 0:
+            lo = max(lo, 1)
+        bounds.append((lo, int(math.floor(x * (1 + error) + 1e-9))))
+    if any([lo > hi for (lo, hi) in bounds]):
+        return None
+    if sum([lo for (lo, hi) in bounds]) > a or sum([hi for (lo, hi) in bounds]) < a:
+        return None
+
+    r = [fewest_bits(max(lo, 0), hi) for (lo, hi) in bounds]
+    gap = a - sum(r)
+    sign = 1 if gap > 0 else -1
+    for k in range(power, -1, -1):
+        step = sign * 2 ** k
+        while abs(gap) >= 2 ** k:
+            best = None
+            for (i, (lo, hi)) in enumerate(bounds):
+                v = r[i] + step
+                if lo <= v <= hi:
+                    cost = bin(v).count('1') - bin(r[i]).count('1')
+                    if best is None or cost < best[0]:
+                        best = (cost, i)
+            if best is None:
+                break
+            r[best[1]] += step
+            gap -= step
+    if gap != 0:
+        return None
+    return r
+
+# Best apportionment of loads over 2^power addresses using at most
+# max_rules rules, by bisection on the allowed error.
+# Returns (normalized loads, error) or None if nothing fits.
+def fit_budget(loads, max_rules, power, rounds=20, live=False):
+    best = None
+    (lo, hi) = (0.0, 1.0)
+    for i in range(rounds):
+        error = hi if best is None else (lo + hi) / 2
+        r = fit_loads(loads, power, error, live)
+        if r is not None and rule_count(r) <= max_rules:
+            best = (r, max_relative_error(loads, r))
+            hi = error
+        elif best is None:
+            return None
+        else:
+            lo = error
+    return best
+
+# Number of servers with load that r gives no addresses
+def zeroed(loads, r):
+    return len([x for (l, x) in zip(loads, r) if l > 0 and x == 0])
+
+# Best apportionment of loads that fits in max_rules prefix rules over
+# any precision up to 2^max_power. Returns (normalized loads, power,
+# error); if nothing fits, the coarsest one is used. Equal errors go to
+# the fit zeroing the fewest servers, then the lowest power.
+def budget_normalize(loads, max_rules, max_power=16):
+    fits = []
+    for power in range(max_power + 1):
+        for live in [False, True]:
+            fit = fit_budget(loads, max_rules, power, live=live)
+            if fit is not None:
+                fits.append((fit[1], zeroed(loads, fit[0]), power, fit[0]))
+    if len(fits) == 0:
+        return (normalize(loads, 1), 0, max_relative_error(loads, normalize(loads, 1)))
+    (error, zeros, power, r) = min(fits)
+    return (r, power, error)
+
+# Error / rule count tradeoff: the best (rules, power, error) for each
+# budget in budgets, e.g. range(len(loads), 4 * len(loads))
+def budget_curve(loads, budgets, max_power=16):
+    curve = []
+    for max_rules in budgets:
+        (r, power, error) = budget_normalize(loads, max_rules, max_power)
+        curve.append((rule_count(r), power, error))
+    return curve
+
+# Closed-form equivalent of nodes_to_rules(weights_to_nodes(...)).
+# Each server's weight splits into its set bits; weights_to_nodes pops
+# the bit 2^k of server s when s has w mod 2^(k+1) left, largest first
+# and lowest server on ties, so sorting the bits by that key gives the
+# same order. Returns (prefix_value, prefix_len, server) integers.
+def weights_to_prefixes(loads, servers=None):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    total = sum(loads)
+    power = max(total - 1, 0).bit_length() # ceil(log2(total))
+
+    parts = []
+    for (w, server) in zip(loads, servers):
+        bits = w
+        while bits:
+            low = bits & -bits
+            parts.append((-(w & (2 * low - 1)), server, low.bit_length() - 1))
+            bits ^= low
+    parts.sort()
+
+    cum_sum = 0
+    prefixes = []
+    for (rem, server, k) in parts:
+        prefixes.append((cum_sum >> k, power - k, server))
+        cum_sum += 1 << k
+    return prefixes
+
+# The bit string nodes_to_rules would give for an integer prefix
+def prefix_to_str(value, length):
+    if length == 0:
+        return ''
+    return bin(value)[2:].zfill(length)
+
+# Merges buddy blocks (start, size) into their parent block wherever
+# both halves are present. Blocks are aligned power of 2 ranges.
+def coalesce(blocks):
+    blocks = set(blocks)
+    sizes = sorted(set([size for (start, size) in blocks]))
+    while len(sizes) > 0:
+        size = sizes.pop(0)
+        for (start, sz) in sorted(blocks):
+            buddy = (start ^ size, size)
+            if sz != size or (start, sz) not in blocks or buddy not in blocks:
+                continue
+            blocks.remove((start, size))
+            blocks.remove(buddy)
+            blocks.add((start & ~size, 2 * size))
+            if 2 * size not in sizes:
+                sizes.insert(0, 2 * size)
+                sizes.sort()
+    return sorted(blocks)
+
+# Reassigns installed (prefix_value, prefix_len, server) prefixes to new
+# loads while keeping as many existing mappings as possible. Shrinking
+# servers keep their largest blocks whole and release only the excess;
+# growing servers get the released space back, buddy-allocated largest
+# request first. Loads are split over 2 ** power, the precision the
+# prefixes were installed with; their lengths alone can not give it, as
+# coalesced rules are shorter. Without it, the coarsest precision that
+# holds both the installed prefixes and loads is used.
+# Returns (prefixes, added, removed, fraction moved).
+def reassign_prefixes(prefixes, loads, servers=None, power=None):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    if power is None:
+        power = max([p[1] for p in prefixes] + [max(sum(loads) - 1, 0).bit_length()])
+    assert all([p[1] <= power for p in prefixes])
+    target = dict(zip(servers, normalize(loads, 2 ** power)))
+
+    owned = {}
+    for (value, length, server) in prefixes:
+        size = 1 << (power - length)
+        owned.setdefault(server, []).append((value * size, size))
+
+    # Space no prefix covers is free from the start
+    free = []
+    end = 0
+    for (start, size) in sorted(sum(owned.values(), []) + [(2 ** power, 0)]):
+        while end < start:
+            gap = end & -end or 2 ** power
+            while end + gap > start:
+                gap /= 2
+            free.append((end, gap))
+            end += gap
+        end = max(end, start + size)
+
+    # Keep up to each server's new load out of what it already owns
+    kept = []
+    for server in sorted(owned):
+        keep = target.get(server, 0)
+        for (start, size) in sorted(owned[server], key=lambda b: (-b[1], b[0])):
+            while True:
+                if size <= keep:
+                    kept.append((start, size, server))
+                    keep -= size
+                    break
+                if keep == 0:
+                    free.append((start, size))
+                    break
+                size /= 2
+                if keep >= size:
+                    kept.append((start, size, server))
+                    keep -= size
+                    start += size
+                else:
+                    free.append((start + size, size))
+
+    # Requests for the missing load, one per set bit, largest first
+    have = {}
+    for (start, size, server) in kept:
+        have[server] = have.get(server, 0) + size
+    requests = []
+    for server in servers:
+        need = target[server] - have.get(server, 0)
+        while need:
+            low = need & -need
+            requests.append((-low, server))
+            need ^= low
+    heapq.heapify(requests)
+
+    pool = {}
+    for (start, size) in coalesce(free):
+        heapq.heappush(pool.setdefault(size, []), start)
+    given = {}
+    while len(requests) > 0:
+        (size, server) = heapq.heappop(requests)
+        size = -size
+        fits = [sz for sz in pool if sz >= size and len(pool[sz]) > 0]
+        if len(fits) == 0: # Too fragmented, ask for two halves instead
+            heapq.heappush(requests, (-(size / 2), server))
+            heapq.heappush(requests, (-(size / 2), server))
+            continue
+        sz = min(fits)
+        start = heapq.heappop(pool[sz])
+        while sz > size: # Split, returning the upper halves to the pool
+            sz /= 2
+            heapq.heappush(pool.setdefault(sz, []), start + sz)
+        given.setdefault(server, []).append((start, size))
+
+    moved = 0
+    result = [(start / size, power - size.bit_length() + 1, server)
+              for (start, size, server) in kept]
+    for server in given:
+        for (start, size) in coalesce(given[server]):
+            moved += size
+            result.append((start / size, power - size.bit_length() + 1, server))
+
+    result.sort(key=lambda p: p[0] << (power - p[1]))
+    old = set(prefixes)
+    new = set(result)
+    added = [p for p in result if p not in old]
+    removed = [p for p in prefixes if p not in new]
+    return (result, added, removed, float(moved) / 2 ** power)
+
+# Minimal-diff reconfiguration from one load vector to another, at the
+# precision of whichever needs more
+def reconfigure(old_loads, new_loads, servers=None):
+    power = max(next_power(sum(old_loads)), next_power(sum(new_loads))).bit_length() - 1
+    old_prefixes = weights_to_prefixes(normalize(old_loads, 2 ** power), servers)
+    return reassign_prefixes(old_prefixes, new_loads, servers, power)
+
+# Dotted-quad string <--> 32-bit int
+def ip_to_int(ip):
+    octets = [int(tok) for tok in ip.split('.')]
+    return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+def int_to_ip(n):
+    return '%d.%d.%d.%d' % ((n >> 24) & 0xff, (n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff)
+
+# Address match for an integer prefix inside a client space such as
+# '10.2.0.0/16', e.g. prefix_to_ip(1, 1, '10.2.0.0/16') == '10.2.128.0/17'
+def prefix_to_ip(prefix, length, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    mask_len = int(base_len) + length
+    IP = ip_to_int(base) | (prefix << (32 - mask_len))
+    return int_to_ip(IP) + '/' + str(mask_len)
+
+# Server of each address in ips (ints) under prefixes within space
+def prefix_lookup(prefixes, ips, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    base = ip_to_int(base)
+    starts = sorted([(base | (p[0] << (32 - int(base_len) - p[1])), p[2]) for p in prefixes])
+    keys = [x[0] for x in starts]
+    return [starts[bisect.bisect_right(keys, ip) - 1][1] for ip in ips]
+
+# Client subnet of the one-switch sandbox load_balancer.py runs in
+SANDBOX_CLIENTS = '10.0.2.0/24'
+
+# Offline comparison of the reactive per-client rules against proactive
+# wildcard rules over space for a list of client addresses (ints).
+# Returns a dict per mode of the packet-ins, rules and clients per server
+# it costs; clients outside space match no wildcard rule and are counted
+# as proactive packet-ins.
+def measure_proactive(ips, num_servers, precision=8, space=SANDBOX_CLIENTS):
+    clients = sorted(set(ips))
+    servers = range(num_servers)
+    (base, base_len) = space.split('/')
+    shift = 32 - int(base_len)
+    inside = [ip for ip in clients if ip >> shift == ip_to_int(base) >> shift]
+
+    reactive = {'packet_ins': len(clients), 'rules': len(clients),
+                'clients': dict((s, 0) for s in servers)}
+    for ip in clients:
+        reactive['clients'][ip % num_servers] += 1
+
+    loads = normalize([1] * num_servers, 2 ** max(precision, next_power(num_servers).bit_length() - 1))
+    prefixes = weights_to_prefixes(loads, servers)
+    proactive = {'packet_ins': len(clients) - len(inside), 'rules': len(prefixes),
+                 'clients': dict((s, 0) for s in servers)}
+    for server in prefix_lookup(prefixes, inside, space):
+        proactive['clients'][server] += 1
+    return {'reactive': reactive, 'proactive': proactive}
+
+# Worst relative deviation of served load {server: load} from the
+# target split loads
+def load_imbalance(served, loads, servers=None):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    total = float(sum(served.values()))
+    share = float(sum(loads))
+    if total == 0:
+        return 0.0
+    errors = [abs(served.get(s, 0) / total - l / share) / (l / share)
+              for (l, s) in zip(loads, servers) if l > 0]
+    return max(errors)
+
+# Union of a non-empty list as a balanced tree, so that combining n
+# rules gives a policy of depth log(n) instead of n
+def union_all(items):
+    while len(items) > 1:
+        pairs = [items[i] | items[i + 1] for i in range(0, len(items) - 1, 2)]
+        if len(items) % 2 == 1:
+            pairs.append(items[-1])
+        items = pairs
+    return items[0]
+
+class PolicyBuilder:
+    '''
+    Collects forwarding rules and flood exclusions, then folds them into
+    a (fwd_policy, flood_policy) pair at once so the pair only needs to
+    be cleaned a single time. Unless counted is False, the rules go into
+    the instrument counts as installed.
+    '''
+
+    def __init__(self, counted=True):
+        self.counted = counted
+        self.pols = []
+        self.preds = []
+        self.removed = []
+
+    def __len__(self):
+        return len(self.pols)
+
+    # Forward pred with pol instead of flooding it
+    def add(self, pred, pol):
+        self.pols.append(pol)
+        self.preds.append(pred)
+
+    # Take pred back out of the forwarding policy
+    def remove(self, pred):
+        self.removed.append(pred)
+
+    def build(self, (fwd_policy, flood_policy)):
+        if self.counted:
+            instrument.count('rules_added', len(self.pols))
+            instrument.count('rules_removed', len(self.removed))
+        if len(self.removed) > 0:
+            fwd_policy = fwd_policy - union_all(self.removed)
+        if len(self.pols) > 0:
+            fwd_policy = fwd_policy | union_all(self.pols)
+        if len(self.preds) > 0:
+            flood_policy = flood_policy - union_all(self.preds)
+        return (fwd_policy, flood_policy)
+
 def test_normalize():
     pop = range(1, 21)
     k = random.sample(pop, 4)
@@ -113,6 +521,16 @@ def test_normalize():
     n = normalize(k)
     print 'n:', n
     print 'sum:', sum(n)
+    assert sum(n) == next_power(sum(k))
+
+    # Fractional weights give whole counts too
+    f = normalize([0.5, 1.25, 2.75, 3.5], 64)
+    assert f == [4, 10, 22, 28], f
+    assert all([isinstance(x, int) for x in normalize([random.random() for i in range(7)], 1024)])
+    # even when they already total a power of 2
+    for seq in [[0.5, 1.5], [1.5, 2.5]]:
+        f = normalize(seq)
+        assert all([isinstance(x, int) for x in f]) and sum(f) == sum(seq), f
     return n
 
 def test_weights_to_nodes():
@@ -129,6 +547,48 @@ def test_nodes_to_rules():
     rules = nodes_to_rules(total_weight, nodes)
     print 'rules:', rules
 
+def test_weights_to_prefixes():
+    n = test_normalize()
+    weights = [(-x[1], x[0], bin(x[1])[2:]) for x in enumerate(n, 2)]
+    nodes = weights_to_nodes(weights)
+    rules = nodes_to_rules(sum(n), nodes)
+    prefixes = weights_to_prefixes(n)
+    print 'prefixes:', prefixes
+    assert rules == [(prefix_to_str(p[0], p[1]), p[2]) for p in prefixes]
+
+def test_reconfigure():
+    old = test_normalize()
+    new = list(old)
+    new[0] += 3
+    (prefixes, added, removed, moved) = reconfigure(old, new)
+    print 'added:', added
+    print 'removed:', removed
+    print 'moved:', moved
+
+    # Every server ends up with exactly its new share of the space
+    cases = [([2, 2], [3, 1]), ([8, 8], [9, 7]), ([4, 4, 8], [5, 3, 8]), (old, new)]
+    for i in range(200):
+        n = random.randint(1, 8)
+        cases.append(([random.randint(1, 20) for s in range(n)], [random.randint(0, 20) for s in range(n)]))
+    for (old, new) in cases:
+        if sum(new) == 0:
+            continue
+        (prefixes, added, removed, moved) = reconfigure(old, new)
+        power = max(next_power(sum(old)), next_power(sum(new))).bit_length() - 1
+        got = dict((s, 0) for s in range(2, 2 + len(new)))
+        for (value, length, server) in prefixes:
+            got[server] += 2 ** (power - length)
+        assert [got[s] for s in sorted(got)] == normalize(new, 2 ** power), (old, new, prefixes)
+
+def test_budget_curve():
+    n = test_normalize()
+    for (rules, power, error) in budget_curve(n, range(len(n), 4 * len(n)), 10):
+        print 'rules: %3d power: %2d error: %.4f' % (rules, power, error)
+
+    # One rule per server: as bad as cutting two servers off, but all live
+    (r, power, error) = budget_normalize([5, 3, 7, 1], 4)
+    assert rule_count(r) <= 4 and zeroed([5, 3, 7, 1], r) == 0, r
+
 import random
 if __name__ == '__main__':
 #    test_normalize()
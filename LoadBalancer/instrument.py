@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import signal
+from collections import deque
+
+# Controller instrumentation: latency histograms for the callbacks,
+# counters and gauges, and a sampled ring buffer of recent packets.
+# Everything is off until enable() is called (or LB_INSTRUMENT is set in
+# the environment), and a disabled probe costs one flag check.
+
+class Histogram:
+    '''
+    Latency histogram with power-of-two microsecond buckets: bucket b
+    holds samples in [2^(b-1), 2^b) us.
+    '''
+
+    def __init__(self, buckets=32):
+        self.buckets = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = int(seconds * 1e6)
+        self.buckets[min(us.bit_length(), len(self.buckets) - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    # Upper bound of the bucket holding the q-quantile, in seconds
+    def quantile(self, q):
+        seen = 0
+        for (b, n) in enumerate(self.buckets):
+            seen += n
+            if seen > 0 and seen >= q * self.count:
+                return (1 << b) / 1e6
+        return 0.0
+
+    def summary(self):
+        mean = self.total / self.count if self.count > 0 else 0.0
+        return {'count': self.count, 'mean': mean, 'max': self.max,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'buckets': self.buckets}
+
+class Stats:
+    '''
+    State shared by every probe in the controller process.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.sample_every = 100
+        self.reset(256)
+
+    def reset(self, ring=256):
+        self.start = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.packets = deque(maxlen=ring)
+        self.seen = 0
+
+stats = Stats()
+
+# Turns instrumentation on. Every sample_every-th packet goes into a ring
+# of the last ring samples. With dump_file, SIGUSR1 writes a snapshot.
+def enable(sample_every=100, ring=256, dump_file=None):
+    stats.reset(ring)
+    stats.sample_every = sample_every
+    stats.enabled = True
+    if dump_file is not None:
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump(dump_file))
+
+def disable():
+    stats.enabled = False
+
+# Decorator recording the latency of every call under name
+def timed(name):
+    def wrap(f):
+        def timed_f(*args, **kwargs):
+            if not stats.enabled:
+                return f(*args, **kwargs)
+            t = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if name not in stats.histograms:
+                    stats.histograms[name] = Histogram()
+                stats.histograms[name].add(time.time() - t)
+        timed_f.__name__ = f.__name__
+        timed_f.__doc__ = f.__doc__
+        return timed_f
+    return wrap
+
+def count(name, n=1):
+    if stats.enabled:
+        stats.counters[name] = stats.counters.get(name, 0) + n
+
+def gauge(name, value):
+    if stats.enabled:
+        stats.gauges[name] = value
+
+# Records a packet-in at switch, keeping a sampled copy of the packet
+def packet_in(switch, inport, packet):
+    if not stats.enabled:
+        return
+    count('packet_in')
+    count('packet_in.%s' % (switch,))
+    stats.seen += 1
+    if stats.seen % stats.sample_every == 1 or stats.sample_every == 1:
+        stats.packets.append({'time': time.time(), 'switch': switch,
+                              'inport': inport, 'packet': str(packet)})
+
+def snapshot():
+    return {'enabled': stats.enabled,
+            'uptime': time.time() - stats.start,
+            'latency': dict((name, h.summary()) for (name, h) in stats.histograms.items()),
+            'counters': stats.counters,
+            'gauges': stats.gauges,
+            'packets': list(stats.packets)}
+
+# Writes a snapshot as JSON to filename, or returns it as a string
+def dump(filename=None):
+    s = json.dumps(snapshot(), indent=2, sort_keys=True)
+    if filename is None:
+        return s
+    f = open(filename, 'w')
+    f.write(s)
+    f.close()
+
+if os.environ.get('LB_INSTRUMENT'):
+    enable(dump_file=os.environ['LB_INSTRUMENT'])
@@ -38,30 +38,45 @@ from nox.lib.packet.ethernet import ethernet
 from nox.lib.packet.arp import arp
 from arpd import extractARP, extractARPType, extractRequest, extractReply
 from learning_switch import adjustPolicy as learningPolicy
+from help_lb import *
+import instrument
 
 # DUMMY IP OF REPLICA SERVER ARRAY
 dummy_ip = '10.0.1.100'
 
+# PROACTIVE MODE: wildcard srcip rules over the whole client space are
+# installed at start instead of one exact-match rule per new client.
+# precision is the number of address-space bits the servers split, and
+# client_space must hold the clients or they all match the first rule.
+proactive = False
+client_space = SANDBOX_CLIENTS
+precision = 8
+
 # Cleans up fwd and flood policies by walking them
+@instrument.timed('clean')
 def clean((fwd_policy, flood_policy)):
     fwd_policy = fwd_policy.walk(NV_parsePolUnion())
     flood_policy = flood_policy.walk(NV_parsePolUnion())
     return (fwd_policy, flood_policy)
 
 # Static Load Balancer Logic
+@instrument.timed('initialize_LB')
 def initialize_LB(args):
     # INITIALLY FLOOD EVERYWHERE AND NEVER FWD
     flood_policy = Pol(PredTop(),[Action([],[openflow.OFPP_FLOOD])])
     fwd_policy = BottomPolicy()
+    policy = PolicyBuilder()
 
     try:
         num_hosts = int(args[0])
     except:
         print >> sys.stderr, '\n-------------------------------'
         print >> sys.stderr, 'ERROR'
-        print >> sys.stderr, "Usage: sudo ./frenetic_run load_balancer num_hosts [num_servers]"
+        print >> sys.stderr, "Usage: sudo ./frenetic_run load_balancer num_hosts [num_servers [proactive [client_space]]]"
         print >> sys.stderr, "ERR: Load Balancer module requires as argument the number of total hosts in the network"
         print >> sys.stderr, "Optional argument: The number of servers to be used in the network"
+        print >> sys.stderr, "Optional argument: 'proactive' to pre-install wildcard client rules"
+        print >> sys.stderr, "Optional argument: The client subnet the wildcard rules split (default %s)" % (SANDBOX_CLIENTS,)
         print >> sys.stderr, '-------------------------------\n'
     else:
         print >> sys.stderr, '\nRunning with %d servers, balancing load over %d servers' % (num_hosts // 2, num_servers)
@@ -88,20 +103,33 @@ def initialize_LB(args):
         mods = [Mod('srcip', dummy_ip)]
         action = Action(mods, [2])
         p = Pol(pred, [action])
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        policy.add(pred, p)
 
-    return clean((fwd_policy,flood_policy))
+        global proactive, client_space
+        proactive = len(args) > 2 and args[2] == 'proactive'
+        if len(args) > 3:
+            client_space = args[3]
+        if proactive:
+            print >> sys.stderr, 'Splitting clients in %s over the servers' % (client_space,)
+            for (pred, p) in proactiveRules():
+                policy.add(pred, p)
+
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Load Balancer Logic
 server_ips = []
 num_servers = 1
+
+# MAC of a replica server given its IP
+def serverMAC(server_ip):
+    return '00:00:00:00:00:%02x' % (int(server_ip.split('.')[-1]) - 1,)
+
+@instrument.timed('balancePolicy')
 def balancePolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
 
     # Perform hash and figure out renaming
     new_dst_ip = server_ips[ ipstr_to_int(packet.header.srcip) % num_servers ]
-    new_macNum = int(new_dst_ip.split('.')[-1]) - 1
-    new_mac = '00:00:00:00:00:%02x' % (new_macNum,)
+    new_mac = serverMAC(new_dst_ip)
 
     # Install rule
     pred = Pred('switch',switch) & Pred('srcip',packet.header.srcip) & Pred('dstip',dummy_ip)
@@ -113,15 +141,30 @@ def balancePolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
 
     return (fwd_policy, flood_policy)
 
+# Wildcard rules splitting client_space evenly over the servers
+# Returns a list of (pred, pol)
+@instrument.timed('proactiveRules')
+def proactiveRules():
+    loads = normalize([1] * num_servers, 2 ** max(precision, next_power(num_servers).bit_length() - 1))
+    rules = []
+    for (prefix, length, server) in weights_to_prefixes(loads, range(num_servers)):
+        new_dst_ip = server_ips[server]
+        pred = Pred('switch', 101) & Pred('srcip', prefix_to_ip(prefix, length, client_space)) & Pred('dstip', dummy_ip)
+        mods = [Mod('dstip', new_dst_ip), Mod('dstmac', serverMAC(new_dst_ip))]
+        action = Action(mods, [1])
+        rules.append((pred, Pol(pred, [action])))
+    return rules
+
 # d : IP --> (mac, port)
+@instrument.timed('adjustPolicy')
 def adjustPolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
 
-    print "!!!! Following packet at switch %d, from port %s" % (switch, packet.header.inport)
-    print packet
+    instrument.packet_in(switch, packet.header.inport, packet)
 
-    # LOAD BALANCER LOGIC
+    # LOAD BALANCER LOGIC (already covered by wildcard rules if proactive)
     if switch == 101 and packet.header.inport == 2:
-        (fwd_policy, flood_policy) = balancePolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy))
+        if not proactive:
+            (fwd_policy, flood_policy) = balancePolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy))
 
     # Learning switch in all other areas
     elif switch != 101:
@@ -138,7 +181,13 @@ def loadBalancer(args):
     # on a different input port.
     # IGNORE LLDP PACKETS AND IPV6 PACKETS (THEY ARE CAUSING TROUBLE AND CAN'T BE PARSED BY NOX)
     qrE = (Select('packets') *
-           Where(or_fp([dltype_fp(ethernet.LLDP_TYPE, pol=False),dltype_fp(0x86dd,pol=False)])) *
+           Where(or_fp([dltype_fp(ethernet.LLDP_TYPE, pol=False),dltype_fp(0x86dd,pol=False)])))
+
+    # IN PROACTIVE MODE, CLIENT PACKETS AT THE LOAD BALANCER NEED NO CONTROLLER
+    if proactive:
+        qrE = qrE * Where(or_fp([switch_fp(101, pol=False), inport_fp(2, pol=False)]))
+
+    qrE = (qrE *
            GroupBy(['switch','srcmac','srcip']) *
            SplitWhen(['inport']) *
            Limit(1))
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+"""
+Open-loop HTTP load generator for the load balancer sandbox.
+
+Requests are sent on a fixed or Poisson arrival schedule regardless of
+how fast earlier ones complete, each from a source address drawn from a
+pool in the client space, as runRandomClients does. Latency is measured
+from the scheduled send time, so queueing behind slow requests counts.
+
+-u, --url         = URL to request
+-r, --rate        = Requests per second
+-T, --duration    = Seconds of arrivals
+-k, --concurrency = Requests in flight at most
+-p, --process     = Arrival process [poisson|fixed]
+-s, --space       = Client space to draw source addresses from
+-N, --num-sources = Size of the source address pool (0 to not bind)
+-A, --sources     = Comma-separated source addresses, instead of a pool
+-o, --output      = Results file (JSON)
+
+Against a local stand-in, use a loopback space such as 127.2.0.0/16,
+which Linux routes to lo without any setup.
+"""
+
+import sys
+import time
+import json
+import socket
+import random
+import httplib
+import urlparse
+import threading
+import Queue
+import numpy as np
+from optparse import OptionParser
+
+# Send times in seconds from start for rate requests/s over duration
+def arrivals(rate, duration, process='poisson', seed=None):
+    if process == 'fixed':
+        return np.arange(0, duration, 1.0 / rate)
+    random = np.random.RandomState(seed)
+    n = int(rate * duration * 1.2) + 10
+    times = np.cumsum(random.exponential(1.0 / rate, n))
+    while times[-1] < duration:
+        times = np.concatenate([times, times[-1] + np.cumsum(random.exponential(1.0 / rate, n))])
+    return times[times < duration]
+
+# n distinct host addresses of space, e.g. '10.2.0.0/16'
+def sourceIPs(n, space='10.2.0.0/16', seed=None):
+    (base, base_len) = space.split('/')
+    base = sum([int(tok) << (24 - 8 * i) for (i, tok) in enumerate(base.split('.'))])
+    size = 1 << (32 - int(base_len))
+    hosts = random.Random(seed).sample(xrange(2, size - 1), min(n, size - 3))
+    return ['%d.%d.%d.%d' % ((ip >> 24) & 0xff, (ip >> 16) & 0xff, (ip >> 8) & 0xff, ip & 0xff)
+            for ip in [base | h for h in hosts]]
+
+# Latency summary of a list of seconds
+def latencySummary(latencies, elapsed):
+    if len(latencies) == 0:
+        return {'requests': 0}
+    a = np.array(latencies)
+    return {'requests': len(a), 'throughput': len(a) / elapsed,
+            'mean': float(a.mean()), 'p50': float(np.percentile(a, 50)),
+            'p99': float(np.percentile(a, 99)), 'p999': float(np.percentile(a, 99.9)),
+            'max': float(a.max())}
+
+class LoadGenerator:
+    '''
+    Dispatches requests at their arrival times to a pool of concurrency
+    worker threads. Each result is (source, server, scheduled, latency,
+    bytes, error); the server is the X-Replica header of the response
+    when the replica sets it.
+    '''
+
+    def __init__(self, url, rate, duration, concurrency=64, process='poisson',
+                 sources=None, timeout=10.0, seed=None):
+        self.url = urlparse.urlparse(url)
+        self.times = arrivals(rate, duration, process, seed)
+        self.concurrency = concurrency
+        self.sources = sources
+        self.timeout = timeout
+        self.random = random.Random(seed)
+        self.queue = Queue.Queue()
+        self.results = []
+        self.lock = threading.Lock()
+
+    def request(self, source):
+        (host, port) = (self.url.hostname, self.url.port or 80)
+        bound = None
+        if source is not None:
+            bound = (source, 0)
+        conn = httplib.HTTPConnection(host, port, timeout=self.timeout, source_address=bound)
+        try:
+            conn.request('GET', self.url.path or '/')
+            response = conn.getresponse()
+            body = response.read()
+            return (response.getheader('X-Replica', '-'), len(body), None if response.status == 200 else response.status)
+        finally:
+            conn.close()
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            (scheduled, source) = item
+            try:
+                (server, size, error) = self.request(source)
+            except (socket.error, httplib.HTTPException), e:
+                (server, size, error) = ('-', 0, str(e))
+            latency = time.time() - scheduled
+            with self.lock:
+                self.results.append((source, server, scheduled, latency, size, error))
+
+    def run(self):
+        workers = [threading.Thread(target=self.worker) for i in range(self.concurrency)]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        self.start = time.time()
+        for t in self.times:
+            delay = self.start + t - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            source = None
+            if self.sources:
+                source = self.random.choice(self.sources)
+            self.queue.put((self.start + t, source))
+
+        for w in workers:
+            self.queue.put(None)
+        for w in workers:
+            w.join()
+        self.elapsed = time.time() - self.start
+        return self.results
+
+    # Latency and throughput overall, per client and per server
+    def summary(self):
+        ok = [r for r in self.results if r[5] is None]
+        clients = {}
+        servers = {}
+        for (source, server, scheduled, latency, size, error) in ok:
+            clients.setdefault(source or '-', []).append(latency)
+            servers.setdefault(server, []).append(latency)
+        return {'url': self.url.geturl(), 'sent': len(self.results),
+                'errors': len(self.results) - len(ok), 'elapsed': self.elapsed,
+                'total': latencySummary([r[3] for r in ok], self.elapsed),
+                'clients': dict((c, latencySummary(l, self.elapsed)) for (c, l) in clients.items()),
+                'servers': dict((s, latencySummary(l, self.elapsed)) for (s, l) in servers.items())}
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-u', '--url', action='store', type='string', dest='url',
+                      default='http://10.1.0.100:8080/ServerData/dummyfile')
+    parser.add_option('-r', '--rate', action='store', type='float', dest='rate', default=100.0)
+    parser.add_option('-T', '--duration', action='store', type='float', dest='duration', default=10.0)
+    parser.add_option('-k', '--concurrency', action='store', type='int', dest='concurrency', default=64)
+    parser.add_option('-p', '--process', action='store', type='string', dest='process', default='poisson')
+    parser.add_option('-s', '--space', action='store', type='string', dest='space', default='10.2.0.0/16')
+    parser.add_option('-N', '--num-sources', action='store', type='int', dest='sources', default=0)
+    parser.add_option('-A', '--sources', action='store', type='string', dest='addresses')
+    parser.add_option('-S', '--seed', action='store', type='int', dest='seed')
+    parser.add_option('-o', '--output', action='store', type='string', dest='output', default='loadgen.json')
+    (options, args) = parser.parse_args()
+    if options.process not in ['poisson', 'fixed']:
+        parser.error('Unknown arrival process: ' + options.process)
+
+    sources = None
+    if options.addresses:
+        sources = options.addresses.split(',')
+    elif options.sources > 0:
+        sources = sourceIPs(options.sources, options.space, options.seed)
+    gen = LoadGenerator(options.url, options.rate, options.duration, options.concurrency,
+                        options.process, sources, seed=options.seed)
+    gen.run()
+    summary = gen.summary()
+
+    f = open(options.output, 'w')
+    json.dump(summary, f, indent=2, sort_keys=True)
+    f.close()
+    total = summary['total']
+    print 'Sent %d requests in %.2fs, %d errors' % (summary['sent'], summary['elapsed'], summary['errors'])
+    if total['requests'] > 0:
+        print 'Throughput %.1f/s, p50 %.4fs, p99 %.4fs, p999 %.4fs' % (
+            total['throughput'], total['p50'], total['p99'], total['p999'])
+
+if __name__ == '__main__':
+    main()
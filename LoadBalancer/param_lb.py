@@ -38,12 +38,18 @@ from nox.lib.packet.ethernet import ethernet
 from nox.lib.packet.arp import arp
 from arpd import extractARP, extractARPType, extractRequest, extractReply
 from help_lb import *
+import instrument
+from affinity import *
+from shard import *
+from allocate import allocatePrefixes
+from analyze import loadTree
 
 # INITIALLY FLOOD EVERYWHERE AND NEVER FWD
 flood_policy = Pol(PredTop(),[Action([],[openflow.OFPP_FLOOD])])
 fwd_policy = BottomPolicy()
 
 # Cleans up fwd and flood policies by walking them
+@instrument.timed('clean')
 def clean((fwd_policy, flood_policy)):
     fwd_policy = fwd_policy.walk(PV_parsePolUnion())
     flood_policy = flood_policy.walk(PV_parsePolUnion())
@@ -52,122 +58,309 @@ def clean((fwd_policy, flood_policy)):
 # Used to initialize a dumb middle switch that simply passes
 # all messages out the other port
 def initialize_Dumb_LB((fwd_policy, flood_policy)):
+    policy = PolicyBuilder()
     pred = Pred('switch', 128) & Pred('inport', 1)
     action = Action([], [2])
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    policy.add(pred, p)
 
     pred = Pred('switch', 128) & Pred('inport', 2)
     action = Action([], [1])
     p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    policy.add(pred, p)
+
+    return clean(policy.build((fwd_policy, flood_policy)))
+
+# SHARDING
+# lb_shards  : (Prefix, Prefix Length, LB) split of 10.2.0.0/16 over the
+#              LB switches, see shard.py for the layout
+# lb_subnets : number of server subnets, one server switch each
+lb_shards = shard_prefixes(1)
+lb_subnets = 1
+
+# Rule sending clients in a 10.2.0.0/16 prefix to a server, from the LB
+# switch of every shard the prefix overlaps
+# Returns (pred, pol) so the pred can also be taken out of the flood policy
+def prefix_rule(prefix, length, server):
+    preds = []
+    pols = []
+    for (value, sublength, lb) in split_prefix(prefix, length, lb_shards):
+        IP_match = prefix_to_ip(value, sublength, '10.2.0.0/16')
+
+        pred = Pred('switch', lb_dpid(lb)) & Pred('srcip', IP_match) & Pred('dstip', '10.1.0.0/24')
+        mods = [Mod('dstip', server_ip(server))]
+        action = Action(mods, [1 + server_slot(server)[0]])
+        p = Pol(pred, [action])
 
-    return clean((fwd_policy, flood_policy))
+        instrument.count('prefix_rules')
+        preds.append(pred)
+        pols.append(p)
+    return (union_all(preds), union_all(pols))
 
 # Load Balancer Logic
-# Assumes loads has already been normalized to sum to a power of 2
-def initialize_LB((fwd_policy, flood_policy), num_servers=2, num_clients=4, dummy_ip='10.1.0.100', loads=None):
+# Assumes loads has already been normalized to sum to a power of 2,
+# unless max_rules is given to fit the rules in a flow-table budget.
+# If histogram names an ordered analyze.py level file of client traffic
+# in 10.2.0.0/16 (analyze.py -o -s 10.2.0.0/16), or a binary one
+# (analyze.py -B -s 10.2.0.0/16), prefixes are split by measured traffic
+# instead of address space.
+# lb_prefixes : currently installed (Prefix, Prefix Length, Server)
+# lb_power    : their precision, loads being split over 2 ** lb_power
+lb_prefixes = []
+lb_power = 0
+@instrument.timed('initialize_LB')
+def initialize_LB((fwd_policy, flood_policy), num_servers=2, num_clients=4, dummy_ip='10.1.0.100', loads=None, max_rules=None, histogram=None, num_lbs=1):
+    global lb_prefixes, lb_power, lb_shards, lb_subnets
+    policy = PolicyBuilder()
+    d.capacity = max(d.capacity, 4 * (num_servers + num_clients))
+    lb_shards = shard_prefixes(num_lbs)
+    lb_subnets = num_subnets(num_servers)
 
     # Modify flows going from servers towards clients
-    pred = Pred('switch', 128) & Pred('srcip','10.1.0.0/24') # Allows for 255 servers
-    mods = [Mod('srcip', dummy_ip)]
-    action = Action(mods, [2])
-    p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
+    for lb in range(num_lbs):
+        pred = Pred('switch', lb_dpid(lb)) & Pred('srcip','10.1.0.0/16') # Subnets of 250 servers
+        mods = [Mod('srcip', dummy_ip)]
+        action = Action(mods, [lb_subnets + 1])
+        p = Pol(pred, [action])
+        policy.add(pred, p)
 
     # Calculate rules
     if loads is None:
         loads = [1, 1]
-    bin_loads = [(-x[1], x[0], bin(x[1])[2:]) for x in enumerate(loads, 2)] # (Weight, Server, Binary Weight)
-    nodes = weights_to_nodes(bin_loads)
-    rules = nodes_to_rules(sum(loads), nodes)
+    if histogram is not None:
+        tree = loadTree(histogram)
+        lb_prefixes = allocatePrefixes(tree, loads) # (Prefix, Prefix Length, Server)
+        lb_power = tree.levels
+        print 'initialize_LB: %d traffic-aware rules from %s' % (len(lb_prefixes), histogram)
+    else:
+        if max_rules is not None:
+            (loads, power, error) = budget_normalize(loads, max_rules)
+            print 'initialize_LB: %d rules at precision /%d, max error %.2f%%' % (rule_count(loads), 16 + power, 100 * error)
+        lb_prefixes = weights_to_prefixes(loads) # (Prefix, Prefix Length, Server)
+        lb_power = next_power(sum(loads)).bit_length() - 1
 
     # Implement rules
-    for rule in rules:
-        IP_tail = int(rule[0]) << (16 - len(rule[0]))
-        IP = '10.2.%d.%d' % ((IP_tail >> 8) & 0xff, IP_tail & 0xff)
-        mask_len = 16 + len(rule[0])
-        IP_match = IP + '/' + str(mask_len)
-
-        pred = Pred('switch', 128) & Pred('srcip', IP_match) & Pred('dstip', '10.1.0.0/24')
-        mods = [Mod('dstip', '10.1.0.' + str(rule[1]))]
-        action = Action(mods, [1])
-        p = Pol(pred, [action])
+    for (prefix, length, server) in lb_prefixes:
+        (pred, p) = prefix_rule(prefix, length, server)
+        policy.add(pred, p)
+
+    return clean(policy.build((fwd_policy, flood_policy)))
+
+# CONNECTION AFFINITY
+# lb_connections : clients recently seen at the load balancer
+# lb_pins        : clients held on their old server after a migration
+# Clients are seen through per-client packet counts polled every
+# ACTIVITY_INTERVAL seconds, well inside the idle timeout.
+lb_connections = ConnectionTable(capacity=4096, idle_timeout=30.0)
+lb_pins = ConnectionTable(capacity=1024, idle_timeout=30.0)
+ACTIVITY_INTERVAL = 10
+
+# Exact-match rule keeping a client on server
+def pin_rule(ip, server):
+    switch = lb_dpid(shard_of(ip, lb_shards))
+    pred = Pred('switch', switch) & Pred('srcip', int_to_ip(ip)) & Pred('dstip', '10.1.0.0/24')
+    mods = [Mod('dstip', server_ip(server))]
+    action = Action(mods, [1 + server_slot(server)[0]])
+    return (pred, Pol(pred, [action]))
+
+# prefix_rule without the clients pinned inside the prefix
+def pinned_prefix_rule(prefix, length, server):
+    (pred, p) = prefix_rule(prefix, length, server)
+    pinned = [pin_rule(ip, s)[0] for (ip, s) in lb_pins.items()
+              if prefix_contains(prefix, length, ip, '10.2.0.0/16')]
+    if len(pinned) > 0:
+        p = p - union_all(pinned)
+    return (pred, p)
+
+# Moves the load balancer to new loads, touching only the prefixes
+# whose server changes. With affinity, clients seen in the last idle
+# timeout stay on their old server until they go idle.
+@instrument.timed('reconfigure_LB')
+def reconfigure_LB((fwd_policy, flood_policy), loads, affinity=True):
+    global lb_prefixes, lb_power
+    policy = PolicyBuilder()
+
+    # Never drop below the installed precision
+    lb_power = max(lb_power, next_power(sum(loads)).bit_length() - 1)
+    old_prefixes = lb_prefixes
+    (lb_prefixes, added, removed, moved) = reassign_prefixes(lb_prefixes, loads, power=lb_power)
+    print 'reconfigure_LB: %d rules added, %d removed, %.2f%% of clients moved' % (len(added), len(removed), 100 * moved)
+
+    # Idle pins go now rather than at the next poll, and so do the least
+    # recently seen ones if the new pins overflow the table
+    if affinity:
+        (pins, released) = pin_migrations(lb_connections, lb_pins, old_prefixes, lb_prefixes, '10.2.0.0/16')
+        print 'reconfigure_LB: %d active clients pinned to their old server' % (len(pins),)
+    else:
+        lb_connections.expire()
+        released = lb_pins.expire()
+    if len(released) > 0:
+        print 'reconfigure_LB: releasing %d pins' % (len(released),)
+
+    for (prefix, length, server) in removed:
+        (pred, p) = prefix_rule(prefix, length, server)
+        policy.remove(pred)
+    for (prefix, length, server) in added:
+        (pred, p) = pinned_prefix_rule(prefix, length, server)
+        policy.add(pred, p)
+    rebuilt = releasePins(policy, released, added)
+
+    # Removing the old prefixes also took out any pins inside them
+    restorePins(policy, removed + rebuilt)
+
+    return clean(policy.build((fwd_policy, flood_policy)))
+
+# Takes the rules of released (ip, server) pins out and rebuilds the
+# prefix rules that excluded them, except those in skip which are being
+# installed anyway. Returns the rebuilt prefixes.
+def releasePins(policy, released, skip=[]):
+    rebuilt = set()
+    for (ip, server) in released:
+        (pred, p) = pin_rule(ip, server)
+        policy.remove(pred)
+        for rule in lb_prefixes:
+            if rule not in skip and prefix_contains(rule[0], rule[1], ip, '10.2.0.0/16'):
+                rebuilt.add(rule)
+    for (prefix, length, server) in rebuilt:
+        (pred, p) = pinned_prefix_rule(prefix, length, server)
+        policy.remove(pred)
+        policy.add(pred, p)
+    return list(rebuilt)
+
+# Puts back the pin rules inside prefixes whose rules were taken out
+def restorePins(policy, prefixes):
+    for (ip, server) in lb_pins.items():
+        if any([prefix_contains(r[0], r[1], ip, '10.2.0.0/16') for r in prefixes]):
+            (pred, p) = pin_rule(ip, server)
+            policy.add(pred, p)
+
+# Records a client seen at the load balancer and releases pins that have
+# gone idle, handing their clients to the current prefix rule
+@instrument.timed('trackConnections')
+def trackConnections((fwd_policy, flood_policy), ip):
+    policy = PolicyBuilder()
+
+    expired = note_activity(ip_to_int(ip), lb_connections, lb_pins, lb_prefixes, '10.2.0.0/16')
+    if len(expired) == 0:
+        return (fwd_policy, flood_policy)
+
+    instrument.count('pins_released', len(expired))
+    rebuilt = releasePins(policy, expired)
 
-        print 'adjustPolicy %s, %s, %s' % (128, IP_match, p)
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+    # Pins still active inside the rebuilt prefixes
+    restorePins(policy, rebuilt)
 
-    return clean((fwd_policy,flood_policy))
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Logic of Client Gateway
 def setClientGateway((fwd_policy, flood_policy)):
+    policy = PolicyBuilder()
     # Match client -> servers
-    pred = Pred('switch', 130) & Pred('dstip', '10.1.0.0/24')
-    action = Action([], [1]) # Send to Load Balancer
-    p = Pol(pred, [action])
-    fwd_policy = fwd_policy | p
-    flood_policy = flood_policy - pred
-    return clean((fwd_policy, flood_policy))
+    for (prefix, length, lb) in lb_shards:
+        pred = Pred('switch', CLIENT_DPID) & Pred('dstip', '10.1.0.0/24')
+        if len(lb_shards) > 1:
+            pred = pred & Pred('srcip', prefix_to_ip(prefix, length, '10.2.0.0/16'))
+        action = Action([], [1 + lb]) # Send to the shard's Load Balancer
+        p = Pol(pred, [action])
+        policy.add(pred, p)
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 # Logic of Server Gateway
 def setServerGateway((fwd_policy, flood_policy), numservers):
+    policy = PolicyBuilder()
+    num_lbs = len(set([lb for (prefix, length, lb) in lb_shards]))
     # Make initial pings unnecessary
     # server IPs start at 2
     for i in range(2, 2 + numservers):
-        ip = '10.1.0.' + str(i)
-        mac = '00:01:02:03:01:%02x' % (i - 1,)
-        pred = Pred('switch', 129) & Pred('dstip', ip)
-        mods = [Mod('dstmac', mac)]
-        action = Action(mods, [i]) # Ports align with IPs
+        pred = Pred('switch', server_switch_dpid(server_slot(i)[0])) & Pred('dstip', server_ip(i))
+        mods = [Mod('dstmac', server_mac(i))]
+        action = Action(mods, [server_port(i, num_lbs)])
         p = Pol(pred, [action])
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        policy.add(pred, p)
 
-    return clean((fwd_policy, flood_policy))
+    return clean(policy.build((fwd_policy, flood_policy)))
 
 
 # LEARNING SWITCH LOGIC
-# d : IP --> (mac, port)
-d = {}
+# d : (switch, IP) --> (pred, pol) of the rule learned for that host
+# Learned rules are kept out of the accumulated policy and unioned in by
+# withHosts, so evicting a host retracts its rule and hands its traffic
+# back to the flood policy. The query only reports a host's first packet
+# per input port, so a forgotten host is never learned again: entries do
+# not expire when idle, and initialize_LB sizes the table to hold every
+# host on each switch it crosses, leaving eviction for stray addresses.
+d = ConnectionTable(capacity=1024, idle_timeout=None)
+@instrument.timed('adjustPolicy')
 def adjustPolicy(((switch,mac,ip),packet),(fwd_policy,flood_policy)):
     global d
 
-    if switch == 128: # Load Balancer shouldn't learn for now (all clients in 10.2.*)
+    instrument.packet_in(switch, packet.header.inport, packet)
+    if is_lb_switch(switch): # Load Balancer shouldn't learn for now (all clients in 10.2.*)
+        if Pred('srcip', '10.2.0.0/16').wild_match(ip):
+            return trackConnections((fwd_policy, flood_policy), ip)
         return (fwd_policy, flood_policy)
 
-    print "!!!! Following packet at switch %d, from port %s" % (switch, packet.header.inport)
-    print packet
-
     # Only client switch remaps MAC
     # Learn on from-client packets
     ip_int = ipstr_to_int(ip)
-    if switch == 130 and Pred('dstip', '10.2.0.0/16').wild_match(ip):
-        print 'Client switch is learning'
-        d[ip] = (mac, packet.header.inport)
+    evicted = []
+    if switch == CLIENT_DPID and Pred('dstip', '10.2.0.0/16').wild_match(ip):
+        instrument.count('client_switch_learned')
         pred = Pred('switch', switch) & Pred('dstip', ip)
         mods = [Mod('dstmac', mac)]
         action = Action(mods, [packet.header.inport])
         p = Pol(pred, [action])
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        if (switch, ip) not in d:
+            instrument.count('rules_added')
+        evicted += d.touch((switch, ip), (pred, p))
 
     # Server switch and LB learn to send back to clients
     # TODO: Deal with multiple-IP MAC addresses
-    if switch == 129 or switch == 128:
+    if is_server_switch(switch) or is_lb_switch(switch):
         pred = Pred('switch', switch) & Pred('dstip', ip)
         action = Action([], [packet.header.inport]) # Should be port 1
         p = Pol(pred, [action])
-        fwd_policy = fwd_policy | p
-        flood_policy = flood_policy - pred
+        if (switch, ip) not in d:
+            instrument.count('rules_added')
+        evicted += d.touch((switch, ip), (pred, p))
+
+    evicted += d.expire()
+    instrument.count('hosts_evicted', len(evicted))
+    instrument.count('rules_removed', len(evicted))
+    instrument.gauge('learned_hosts', len(d))
 
 #    print "post-fwd_policy:\n%s" % fwd_policy
 #    print "post-flood_policy:\n%s" % flood_policy
 #    print "---- end adjustPolicy --------"
-    return clean((fwd_policy,flood_policy))
+    return (fwd_policy, flood_policy)
+
+# Adds the currently learned host rules to an accumulated policy pair.
+# They were counted when learned, so rebuilding them here is not.
+@instrument.timed('withHosts')
+def withHosts((fwd_policy, flood_policy)):
+    policy = PolicyBuilder(counted=False)
+    for (host, (pred, p)) in d.items():
+        policy.add(pred, p)
+    instrument.gauge('lb_rules', len(lb_prefixes))
+    instrument.gauge('pinned_clients', len(lb_pins))
+    instrument.gauge('policy_rules', len(lb_prefixes) + len(lb_pins) + len(d))
+    return clean(policy.build((fwd_policy, flood_policy)))
+
+# Counts of a client's packets at a switch over the last interval keep
+# its connection or pin alive while it sends
+@instrument.timed('adjustActivity')
+def adjustActivity(((switch,ip),count),(fwd_policy,flood_policy)):
+    if count > 0 and is_lb_switch(switch) and Pred('srcip', '10.2.0.0/16').wild_match(ip):
+        return trackConnections((fwd_policy, flood_policy), ip)
+    return (fwd_policy, flood_policy)
+
+# Merged events carry a first packet, a packet count, or both
+def adjustBoth((packet_event, count_event), policies):
+    if packet_event is not None:
+        policies = adjustPolicy(packet_event, policies)
+    if count_event is not None:
+        policies = adjustActivity(count_event, policies)
+    return policies
 
 # rules : unit -> E policy
 rules_e = None
@@ -181,10 +374,16 @@ def rules():
              GroupBy(['switch','srcmac','srcip']) *
              SplitWhen(['inport']) *
              Limit(1))
+        # query: packets from every host on every switch, counted on
+        # the switches and reported every ACTIVITY_INTERVAL seconds
+        cq = (Select('counts') *
+              GroupBy(['switch','srcip']) *
+              Every(ACTIVITY_INTERVAL))
         # accumulate policy
-        ef = (Accum((fwd_policy,flood_policy),adjustPolicy) >>
+        ef = (Accum((fwd_policy,flood_policy),adjustBoth) >>
+              Lift(withHosts) >>
               Lift(lambda dbl: dbl[0] | dbl[1]))
-        rules_e = q >> Probe("\nquery results: ") >> ef
+        rules_e = Merge(q >> Probe("\nquery results: "), cq) >> ef
     return rules_e
 
 
@@ -194,12 +393,18 @@ def main(*args):
     num_clients = 4
     dummy_ip = '10.1.0.100'
     loads_file = '/home/openflow/frenetic/LoadBalancer/loads.txt'
+    max_rules = None
+    histogram = None
+    num_lbs = 1
     print args
     try:
         num_servers = int(args[0])
         num_clients = int(args[1])
         dummy_ip = args[2]
         loads_file = args[3]
+        max_rules = int(args[4]) or None # 0 for no budget
+        histogram = args[5] or None # '' for address-space rules
+        num_lbs = int(args[6])
     except IndexError:
         pass
 
@@ -213,7 +418,7 @@ def main(*args):
 
     global fwd_policy
     global flood_policy
-    (fwd_policy, flood_policy) = initialize_LB((fwd_policy, flood_policy), num_servers, num_clients, dummy_ip, loads)
+    (fwd_policy, flood_policy) = initialize_LB((fwd_policy, flood_policy), num_servers, num_clients, dummy_ip, loads, max_rules, histogram, num_lbs)
 #    (fwd_policy, flood_policy) = initialize_Dumb_LB((fwd_policy, flood_policy))
 #    print "!!!!! Forward policy:", fwd_policy
 #    print "!!!!! Flood policy:", flood_policy
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+
+"""
+Instrumented replica server, standing in for mongoose in the sandbox.
+
+Serves files under a root directory (ServerData/dummyfile by default)
+from a thread per request, and keeps request, byte and service latency
+totals. Every response carries an X-Replica header with the server id,
+and GET /stats returns the totals as JSON. They are also written to the
+stats file every few seconds and on exit.
+
+-i, --id           = Server id, as the controller numbers them (2, 3, ...)
+-p, --port         = Port to listen on
+-R, --root         = Directory to serve
+-t, --service-time = Extra seconds spent on every request, to emulate a
+                     slower server
+-o, --output       = Stats file (JSON)
+
+--report loads.txt stats... compares the totals of several replicas with
+the target loads.
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import threading
+import posixpath
+import urllib
+import BaseHTTPServer
+import SocketServer
+from optparse import OptionParser
+from help_lb import load_imbalance
+from instrument import Histogram
+
+class ReplicaStats:
+    '''
+    Totals of one replica, safe to update from the request threads.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.start = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def record(self, client, size, latency, ok=True):
+        with self.lock:
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.bytes += size
+            self.latency.add(latency)
+            self.clients[client] = self.clients.get(client, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            return {'server': self.server, 'elapsed': elapsed,
+                    'requests': self.requests, 'errors': self.errors, 'bytes': self.bytes,
+                    'throughput': self.requests / elapsed, 'clients': len(self.clients),
+                    'latency': self.latency.summary()}
+
+    def write(self, filename):
+        f = open(filename + '.tmp', 'w')
+        json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        f.close()
+        os.rename(filename + '.tmp', filename)
+
+class ReplicaHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''
+    Serves GET requests for files under the server's root, and /stats.
+    '''
+
+    def do_GET(self):
+        start = time.time()
+        if self.path == '/stats':
+            self.reply(200, json.dumps(self.server.stats.snapshot(), sort_keys=True), 'application/json')
+            return
+
+        if self.server.serviceTime > 0:
+            time.sleep(self.server.serviceTime)
+        path = self.translate(self.path)
+        try:
+            f = open(path, 'rb')
+            body = f.read()
+            f.close()
+            status = 200
+        except IOError:
+            (status, body) = (404, 'Not found\n')
+        self.reply(status, body, 'application/octet-stream')
+        self.server.stats.record(self.client_address[0], len(body), time.time() - start, status == 200)
+
+    def reply(self, status, body, ctype):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Replica', str(self.server.stats.server))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # URL path --> file under root, without leaving it
+    def translate(self, path):
+        path = posixpath.normpath(urllib.unquote(path.split('?', 1)[0]))
+        words = [w for w in path.split('/') if w and w not in (os.curdir, os.pardir)]
+        return os.path.join(self.server.root, *words)
+
+    def log_message(self, format, *args):
+        pass
+
+class ReplicaServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, server, root='.', serviceTime=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, ReplicaHandler)
+        self.stats = ReplicaStats(server)
+        self.root = root
+        self.serviceTime = serviceTime
+
+# Writes stats to filename every interval seconds until the process exits
+def writePeriodically(stats, filename, interval=5.0):
+    def loop():
+        while True:
+            time.sleep(interval)
+            stats.write(filename)
+    t = threading.Thread(target=loop)
+    t.daemon = True
+    t.start()
+
+# Achieved split of several replicas' stats files against loads.txt
+def report(loadsFile, statsFiles):
+    f = open(loadsFile, 'r')
+    loads = [int(x) for x in f.readline().split()]
+    f.close()
+    servers = range(2, 2 + len(loads))
+
+    served = dict((s, 0) for s in servers)
+    for name in statsFiles:
+        f = open(name, 'r')
+        stats = json.load(f)
+        f.close()
+        served[stats['server']] = served.get(stats['server'], 0) + stats['requests']
+
+    total = float(max(sum(served.values()), 1))
+    for (l, s) in zip(loads, servers):
+        print 'server %-4d target %7.3f%%  served %7.3f%%  (%d)' % (
+            s, 100.0 * l / sum(loads), 100 * served[s] / total, served[s])
+    print 'imbalance: %.4f' % (load_imbalance(served, loads, servers),)
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options] | --report loads.txt stats...')
+    parser.add_option('-i', '--id', action='store', type='int', dest='server', default=2)
+    parser.add_option('-p', '--port', action='store', type='int', dest='port', default=8080)
+    parser.add_option('-R', '--root', action='store', type='string', dest='root', default='.')
+    parser.add_option('-t', '--service-time', action='store', type='float', dest='serviceTime', default=0.0)
+    parser.add_option('-o', '--output', action='store', type='string', dest='output')
+    parser.add_option('--report', action='store', type='string', dest='report')
+    (options, args) = parser.parse_args()
+
+    if options.report is not None:
+        report(options.report, args)
+        return
+
+    output = options.output or 'replica%d.json' % (options.server,)
+    httpd = ReplicaServer(('', options.port), options.server, options.root, options.serviceTime)
+    writePeriodically(httpd.stats, output)
+
+    def stop(signum, frame):
+        httpd.stats.write(output)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    main()
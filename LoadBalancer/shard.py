@@ -0,0 +1,143 @@
+import random
+from help_lb import *
+from affinity import prefix_contains
+
+# Layout of a sharded load balancer, shared by param_lb and LB_sandbox
+# so that it can be checked without Mininet.
+#
+# LB switch j (DPID 0x80 + 0x100 j) handles the clients of shard j of
+# 10.2.0.0/16 and forwards them to any server. Replica servers sit in
+# /24 subnets of 10.1.0.0/16, SERVERS_PER_SUBNET to a subnet, each
+# subnet behind its own server switch (DPID 0x81 + 0x100 k). All LB
+# switches hang off the one client switch (DPID 0x82).
+#
+# LB switch j:         port 1 + k  --> server switch k, port num_subnets + 1 --> client switch
+#                      (so with one LB and one subnet, 1 --> servers, 2 --> clients)
+# Server switch k:     port 1 + j  --> LB switch j, port num_lbs + 1 + i --> server i of subnet k
+# Client switch:       port 1 + j  --> LB switch j, port num_lbs + 1 + i --> client i
+#
+# Servers are numbered from 2 like the controllers do, so server s is
+# 10.1.0.s for the first subnet up to the default dummy IP 10.1.0.100,
+# whose host number every subnet skips.
+
+SERVERS_PER_SUBNET = 250
+DUMMY_HOST = 100
+CLIENT_DPID = 0x82
+
+def lb_dpid(j):
+    return 0x80 + 0x100 * j
+
+def server_switch_dpid(k):
+    return 0x81 + 0x100 * k
+
+def num_subnets(num_servers):
+    return max((num_servers + SERVERS_PER_SUBNET - 1) // SERVERS_PER_SUBNET, 1)
+
+def is_lb_switch(switch):
+    return switch & 0xff == 0x80
+
+def is_server_switch(switch):
+    return switch & 0xff == 0x81
+
+# MAC, and so DPID, of a switch
+def switch_mac(dpid):
+    return '00:00:00:00:%02x:%02x' % (dpid >> 8, dpid & 0xff)
+
+# (subnet, index in subnet) of server s
+def server_slot(server):
+    return divmod(server - 2, SERVERS_PER_SUBNET)
+
+def server_ip(server):
+    (k, i) = server_slot(server)
+    host = i + 2
+    if host >= DUMMY_HOST:
+        host += 1
+    return '10.1.%d.%d' % (k, host)
+
+def server_mac(server):
+    (k, i) = server_slot(server)
+    return '00:01:02:%02x:01:%02x' % (3 + k, i + 1)
+
+def server_gateway(server):
+    (k, i) = server_slot(server)
+    return '10.1.%d.1' % (k,)
+
+# MAC of the server switch port facing server s
+def server_gateway_mac(server):
+    (k, i) = server_slot(server)
+    return '00:01:02:%02x:11:%02x' % (3 + k, i + 1)
+
+# Port of server s on its server switch
+def server_port(server, num_lbs=1):
+    return num_lbs + 1 + server_slot(server)[1]
+
+# Clients are numbered from 1, 250 to a /24 of 10.2.0.0/16
+def client_ip(client):
+    (k, i) = divmod(client - 1, SERVERS_PER_SUBNET)
+    return '10.2.%d.%d' % (k, i + 2)
+
+def client_mac(client):
+    (k, i) = divmod(client - 1, SERVERS_PER_SUBNET)
+    return '00:01:02:%02x:02:%02x' % (3 + k, i + 1)
+
+# MAC of the client switch port facing client c
+def client_gateway_mac(client):
+    (k, i) = divmod(client - 1, SERVERS_PER_SUBNET)
+    return '00:01:02:%02x:22:%02x' % (3 + k, i + 1)
+
+# Split of the client space over num_lbs LB switches as
+# (prefix_value, prefix_len, lb) prefixes, equal shares at precision bits
+def shard_prefixes(num_lbs, precision=8):
+    power = max(precision, next_power(num_lbs).bit_length() - 1)
+    return weights_to_prefixes(normalize([1] * num_lbs, 2 ** power), range(num_lbs))
+
+# Pieces of prefix (value, length) in each shard it overlaps, as
+# (value, length, lb) with the longer of the two prefixes
+def split_prefix(value, length, shards):
+    pieces = []
+    for (s_value, s_length, lb) in shards:
+        if s_length <= length:
+            if value >> (length - s_length) == s_value:
+                pieces.append((value, length, lb))
+        elif s_value >> (s_length - length) == value:
+            pieces.append((s_value, s_length, lb))
+    return pieces
+
+# Rules of each LB switch for the (prefix_value, prefix_len, server)
+# rules of the whole client space: {lb: [(value, length, server)]}
+def shard_rules(prefixes, shards):
+    rules = dict((lb, []) for (v, l, lb) in shards)
+    for (value, length, server) in prefixes:
+        for (v, l, lb) in split_prefix(value, length, shards):
+            rules[lb].append((v, l, server))
+    return rules
+
+# LB switch of a client address (int) in space
+def shard_of(ip, shards, space='10.2.0.0/16'):
+    return prefix_lookup(shards, [ip], space)[0]
+
+# Sharded rules send every client to the same server as the unsharded
+# ones, through the LB switch of its shard
+def test_shard_rules(num_lbs=6, num_servers=600, num_clients=10000):
+    loads = normalize([random.randint(1, 20) for i in range(num_servers)])
+    prefixes = weights_to_prefixes(loads)
+    shards = shard_prefixes(num_lbs)
+    rules = shard_rules(prefixes, shards)
+    print 'rules:', len(prefixes), 'per LB switch:', [len(rules[lb]) for lb in sorted(rules)]
+
+    space = ip_to_int('10.2.0.0')
+    ips = sorted([space | random.getrandbits(16) for i in range(num_clients)])
+    expected = prefix_lookup(prefixes, ips, '10.2.0.0/16')
+    lbs = prefix_lookup(shards, ips, '10.2.0.0/16')
+    for (ip, lb, server) in zip(ips, lbs, expected):
+        mine = [r for r in rules[lb] if prefix_contains(r[0], r[1], ip, '10.2.0.0/16')]
+        assert len(mine) == 1 and mine[0][2] == server, (int_to_ip(ip), lb, server, mine)
+    assert num_subnets(num_servers) == 3
+    assert server_ip(2) == '10.1.0.2' and server_ip(99) == '10.1.0.99' and server_ip(100) == '10.1.0.101'
+    assert server_ip(251) == '10.1.0.252' and server_ip(252) == '10.1.1.2'
+    assert '10.1.0.100' not in [server_ip(s) for s in range(2, 2 + num_servers)]
+    assert client_ip(1) == '10.2.0.2' and client_mac(1) == '00:01:02:03:02:01'
+    print 'ok'
+
+if __name__ == '__main__':
+    test_shard_rules()
@@ -0,0 +1,147 @@
+import heapq
+from tree import *
+
+# Greedy allocation of measured load to servers. Disjoint subtrees of a
+# weighted BinaryTree are handed out largest first to whichever server
+# is furthest below its target, and a subtree is only split when it is
+# too big for that server. Every leaf ends up in exactly one rule, so
+# the rules cover the whole address space.
+
+# Merges sibling prefixes assigned to the same server into their parent
+def mergeSiblings(assigned):
+    # Deepest (largest index) first, so merged parents can merge again
+    frontier = [-i for i in assigned]
+    heapq.heapify(frontier)
+    while len(frontier) > 0:
+        i = -heapq.heappop(frontier)
+        if i == 1 or i not in assigned or (i ^ 1) not in assigned:
+            continue
+        if assigned[i] != assigned[i ^ 1]:
+            continue
+        server = assigned.pop(i)
+        del assigned[i ^ 1]
+        assigned[i >> 1] = server
+        heapq.heappush(frontier, -(i >> 1))
+    return assigned
+
+# Returns {node index: server} for the given targets
+# loads   - desired relative load of each server
+# servers - server ids, defaulting to 2, 3, ... like param_lb
+def allocateNodes(tree, loads, servers=None):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    assert len(servers) == len(loads) > 0
+
+    total = tree.root.value
+    share = float(sum(loads))
+    # (-deficit, server) since heapq is a minPQ
+    deficits = [(-(total * l / share), s) for (l, s) in zip(loads, servers)]
+    return mergeSiblings(assignNodes(tree, [1], deficits, {}))
+
+# Hands the subtrees at indices out largest first to the server furthest
+# below its target, splitting those too big for it, into assigned
+# deficits - (-deficit, server) pairs
+# slack   - load a server may take beyond its deficit, by server
+def assignNodes(tree, indices, deficits, assigned, slack={}):
+    heapq.heapify(deficits)
+    nodes = [tree.key(i) for i in indices]
+    heapq.heapify(nodes)
+    while len(nodes) > 0:
+        (negValue, depth, rank, i) = heapq.heappop(nodes)
+        (negDeficit, server) = deficits[0]
+        node = tree.node(i)
+        if -negValue <= max(-negDeficit, 0) + slack.get(server, 0) or node.isLeaf():
+            assigned[i] = server
+            heapq.heapreplace(deficits, (negDeficit - negValue, server))
+        else:
+            heapq.heappush(nodes, tree.key(i << 1))
+            heapq.heappush(nodes, tree.key((i << 1) | 1))
+    return assigned
+
+# Moves installed (prefix_value, prefix_len, server) prefixes toward the
+# targets with as few rule changes as possible, as
+# help_lb.reassign_prefixes does by address count but by measured load.
+# A server over its target keeps its largest subtrees up to it, split
+# down one path where one would overshoot, and releases the rest; the
+# released subtrees then go to the servers below their targets as in
+# allocateNodes. Servers within their targets keep every rule. Each
+# server may land up to slack (relative to its target) off, which saves
+# splitting subtrees finer than that.
+def reallocateNodes(tree, prefixes, loads, servers=None, slack=0.0):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    assert all([p[1] <= tree.levels for p in prefixes])
+
+    total = tree.root.value
+    share = float(sum(loads))
+    target = dict((s, total * l / share) for (l, s) in zip(loads, servers))
+    tolerance = dict((s, slack * t) for (s, t) in target.items())
+    owned = {}
+    for (value, length, server) in prefixes:
+        owned.setdefault(server, []).append((1 << length) | value)
+
+    (assigned, released) = ({}, [])
+    for server in sorted(owned):
+        (keep, tol) = (target.get(server, 0), tolerance.get(server, 0))
+        for i in sorted(owned[server], key=tree.key):
+            # Split down one path, keeping or releasing the other halves
+            while True:
+                value = int(tree.values[i])
+                if value <= keep + tol:
+                    assigned[i] = server
+                    keep -= value
+                    break
+                if keep <= tol or tree.node(i).isLeaf():
+                    if value < 2 * keep: # Closer to the target kept
+                        assigned[i] = server
+                        keep -= value
+                    else:
+                        released.append(i)
+                    break
+                (heavy, light) = sorted([i << 1, (i << 1) | 1], key=tree.key)
+                if int(tree.values[heavy]) <= keep + tol:
+                    (half, i) = (heavy, light)
+                else:
+                    (half, i) = (light, heavy)
+                if int(tree.values[half]) <= keep + tol:
+                    assigned[half] = server
+                    keep -= int(tree.values[half])
+                else:
+                    released.append(half)
+
+    kept = {}
+    for (i, server) in assigned.items():
+        kept[server] = kept.get(server, 0) + int(tree.values[i])
+    deficits = [(-(target[s] - kept.get(s, 0)), s) for s in servers]
+    return mergeSiblings(assignNodes(tree, released, deficits, assigned, tolerance))
+
+# Same (prefix, server) shape as help_lb.nodes_to_rules, in address order
+def allocate(tree, loads, servers=None):
+    assigned = allocateNodes(tree, loads, servers)
+    nodes = sorted(assigned, key=lambda i: tree.node(i).name)
+    return [(tree.node(i).name, assigned[i]) for i in nodes]
+
+# Same rules as (prefix_value, prefix_len, server) integers, the form
+# help_lb.weights_to_prefixes returns
+def allocatePrefixes(tree, loads, servers=None):
+    return nodesToPrefixes(tree, allocateNodes(tree, loads, servers))
+
+def nodesToPrefixes(tree, assigned):
+    prefixes = []
+    for i in assigned:
+        depth = depthOf(i)
+        prefixes.append((i ^ (1 << depth), depth, assigned[i]))
+    prefixes.sort(key=lambda p: p[0] << (tree.levels - p[1]))
+    return prefixes
+
+# reallocateNodes as (prefix_value, prefix_len, server) integers
+def reallocatePrefixes(tree, prefixes, loads, servers=None, slack=0.0):
+    return nodesToPrefixes(tree, reallocateNodes(tree, prefixes, loads, servers, slack))
+
+# Measured load each server receives under rules
+def ruleLoads(tree, rules):
+    loads = {}
+    for (prefix, server) in rules:
+        i = int('1' + prefix, 2)
+        loads[server] = loads.get(server, 0) + int(tree.values[i])
+    return loads
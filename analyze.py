@@ -1,9 +1,26 @@
-
+import os
 import sys
+import mmap
+import time
+import struct
+import numpy as np
+from multiprocessing import Pool, cpu_count
 from tree import *
-from optparser import OptionParser
+from sketch import PrefixSketch
+from trie import SparseTree
+from optparse import OptionParser
+
+# Counts can be limited to a client space such as '10.2.0.0/16', in which
+# case prefixes are taken from the bits after the space's own prefix.
+# Files normally list each level's counts largest first; ordered files
+# list them by prefix instead, so they can be loaded back into a tree.
+# With -B all levels go to the single binary file named by -p instead.
+
+def analyze(input, prefix, depth, space='0.0.0.0/0', ordered=False):
+    (base, base_len) = space.split('/')
+    base_len = int(base_len)
+    base_bits = bin((1 << 32) | ipToInt(base))[3:3 + base_len]
 
-def analyze(input, prefix, depth):
     f = open(input, 'r')
     tree = BinaryTree(levels=depth)
     for line in f:
@@ -11,34 +28,249 @@ def analyze(input, prefix, depth):
 
         # Convert to binary and pad to 8 bits
         bins = [bin(int(tok))[2:] for tok in toks]
-        pad = [''.join(['0' for i in range(8-len(bin))]) + bin for bin in bins]
+        pad = [''.join(['0' for i in range(8-len(b))]) + b for b in bins]
         print pad
 
         full = ''.join(pad)
-        tree.insert(full[:depth])
+        if not full.startswith(base_bits):
+            continue
+        tree.insert(full[base_len:base_len + depth])
     f.close()
 
-    nodes = [tree.root]
     for i in range(depth):
-        nodes2 = []
-        for node in nodes:
-            if node.left is not None:
-                nodes2.append(node.left)
-            if node.right is not None:
-                nodes2.append(node.right)
-        nodes = nodes2
+        if ordered:
+            order = np.arange(2 ** (i + 1), 2 ** (i + 2))
+        else:
+            order = tree.sortedLevel(i + 1)
+        f = open(prefix + str(i+1), 'w')
+        f.write('\n'.join([str(v) for v in tree.values[order]]))
+        f.close()
+
+# Parses a list of dotted-quad lines into an array of 32-bit addresses
+def parseChunk(lines):
+    return parseText(''.join(lines))
+
+def parseText(text):
+    text = text.replace(':', ' ').replace('.', ' ')
+    octets = np.fromstring(text, dtype=np.uint32, sep=' ').reshape(-1, 4)
+    return ((octets[:, 0] << 24) | (octets[:, 1] << 16) |
+            (octets[:, 2] << 8) | octets[:, 3])
+
+# Yields the addresses of a trace file chunk lines at a time
+def readTrace(input, chunk=2**20):
+    f = open(input, 'r')
+    lines = f.readlines(chunk * 16)
+    while len(lines) > 0:
+        yield parseChunk(lines)
+        lines = f.readlines(chunk * 16)
+    f.close()
+
+# Counts of every prefix of length depth, indexed by prefix value
+def histogram(ips, depth, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    base_len = int(base_len)
+    if base_len > 0:
+        ips = ips[(ips >> (32 - base_len)) == (ipToInt(base) >> (32 - base_len))]
+        ips = ips & np.uint32((1 << (32 - base_len)) - 1)
+    if base_len + depth == 0: # Shifting uint32s by 32 leaves them as they are
+        return np.array([len(ips)], dtype=np.int64)
+    return np.bincount(ips >> (32 - base_len - depth), minlength=2 ** depth).astype(np.int64)
+
+# Per-level counts for levels 1..depth from the deepest histogram, so
+# none for depth 0 (whose histogram is just the total)
+def levelCounts(hist, depth):
+    if depth == 0:
+        return []
+    levels = [hist]
+    for i in range(depth - 1):
+        levels.append(levels[-1].reshape(-1, 2).sum(axis=1))
+    levels.reverse()
+    return levels
+
+# Same format as analyze(): one file per level
+def writeLevels(prefix, levels, ordered=False):
+    for (i, counts) in enumerate(levels):
+        if not ordered:
+            counts = np.sort(counts)[::-1]
         f = open(prefix + str(i+1), 'w')
-        f.write('\n'.join([str(n.value) for n in sorted(nodes)]))
+        f.write('\n'.join([str(c) for c in counts]))
         f.close()
 
+# Level files under prefix, or with binary the one binary file prefix
+def writeOutput(prefix, levels, ordered=False, binary=False, source=''):
+    if binary:
+        writeBinary(prefix, levels, source)
+    else:
+        writeLevels(prefix, levels, ordered)
+
+def analyzeBatch(input, prefix, depth, chunk=2**20, space='0.0.0.0/0', ordered=False, binary=False):
+    hist = np.zeros(2 ** depth, dtype=np.int64)
+    for ips in readTrace(input, chunk):
+        hist += histogram(ips, depth, space)
+    writeOutput(prefix, levelCounts(hist, depth), ordered, binary, input)
+
+# Same files from a PrefixSketch of capacity counters per level instead
+# of exact counts: hot prefixes keep their weight, cold space is spread
+# evenly
+def analyzeSketch(input, prefix, depth, capacity, chunk=2**20, space='0.0.0.0/0', ordered=False, binary=False):
+    sketch = PrefixSketch(depth, capacity, space)
+    for ips in readTrace(input, chunk):
+        sketch.addIPs(ips)
+    tree = sketch.toTree()
+    writeOutput(prefix, [tree.values[2 ** l:2 ** (l + 1)] for l in range(1, depth + 1)], ordered, binary, input)
+
+# Same files as analyzeBatch without the trailing zeros of each level,
+# from a SparseTree, so depths up to 32 fit in memory proportional to
+# the distinct clients. Only largest-first files can be written this way.
+def analyzeSparse(input, prefix, depth, chunk=2**20, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    base_len = int(base_len)
+    assert base_len + depth <= 32
+    tree = SparseTree(levels=depth)
+    for ips in readTrace(input, chunk):
+        ips = ips.astype(np.int64)
+        if base_len > 0:
+            ips = ips[(ips >> (32 - base_len)) == (ipToInt(base) >> (32 - base_len))]
+        tree.addIPs((ips << base_len) & 0xffffffff)
+    writeLevels(prefix, [tree.levelCounts(l)[1] for l in range(1, depth + 1)])
+
+# PARALLEL MODE
+# Trace files are memory-mapped and cut into line-aligned byte ranges of
+# about chunk bytes, which a process pool turns into partial histograms.
+# Addition commutes, so the merged counts, and the files written, are
+# the same as the serial path's.
+
+# (input, start, end) ranges of a trace, each ending after a newline
+def splitTrace(input, chunk=2**26):
+    size = os.path.getsize(input)
+    if size == 0:
+        return []
+    f = open(input, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    ranges = []
+    start = 0
+    while start < size:
+        end = mm.find('\n', min(start + chunk, size) - 1)
+        end = size if end < 0 else end + 1
+        ranges.append((input, start, end))
+        start = end
+    mm.close()
+    f.close()
+    return ranges
+
+# Histogram of one range, run in a worker process
+def histogramRange((input, start, end, depth, space)):
+    f = open(input, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    hist = histogram(parseText(mm[start:end]), depth, space)
+    mm.close()
+    f.close()
+    return hist
+
+def analyzeParallel(inputs, prefix, depth, processes=None, chunk=2**26, space='0.0.0.0/0', ordered=False, binary=False):
+    tasks = []
+    for input in inputs:
+        tasks += [r + (depth, space) for r in splitTrace(input, chunk)]
+
+    hist = np.zeros(2 ** depth, dtype=np.int64)
+    pool = Pool(processes or cpu_count())
+    for part in pool.imap_unordered(histogramRange, tasks):
+        hist += part
+    pool.close()
+    pool.join()
+    writeOutput(prefix, levelCounts(hist, depth), ordered, binary, ','.join(inputs))
+
+# Counts of an ordered level file, indexed by prefix
+def readLevel(filename):
+    f = open(filename, 'r')
+    counts = np.fromstring(f.read(), dtype=np.int64, sep='\n')
+    f.close()
+    return counts
+
+# BINARY FORMAT
+# One file holding every level in prefix order, laid out as the values
+# array of a BinaryTree: int64 counts at heap indices 0 (unused, 0), 1
+# (the total) and 2^l .. 2^(l+1)-1 for level l. A header of
+#     magic, version, depth, item size, timestamp, source length
+# and the source name padded to 8 bytes comes first, so the counts can be
+# memory-mapped and used without parsing.
+BINARY_MAGIC = 'LBHIST\0\0'
+BINARY_HEADER = struct.Struct('<8sIIIdI')
+
+def writeBinary(filename, levels, source=''):
+    depth = len(levels)
+    pad = (-(BINARY_HEADER.size + len(source))) % 8
+    f = open(filename, 'wb')
+    f.write(BINARY_HEADER.pack(BINARY_MAGIC, 1, depth, 8, time.time(), len(source)))
+    f.write(source + '\0' * pad)
+    total = levels[0].sum() if depth > 0 else 0
+    np.array([0, total], dtype='<i8').tofile(f)
+    for counts in levels:
+        np.asarray(counts, dtype='<i8').tofile(f)
+    f.close()
+
+def isBinary(filename):
+    f = open(filename, 'rb')
+    magic = f.read(len(BINARY_MAGIC))
+    f.close()
+    return magic == BINARY_MAGIC
+
+# Header of a binary file as a dict, with the offset of the counts
+def readBinaryHeader(filename):
+    f = open(filename, 'rb')
+    (magic, version, depth, itemsize, timestamp, length) = BINARY_HEADER.unpack(f.read(BINARY_HEADER.size))
+    source = f.read(length)
+    f.close()
+    assert magic == BINARY_MAGIC and version == 1 and itemsize == 8
+    offset = BINARY_HEADER.size + length + (-(BINARY_HEADER.size + length)) % 8
+    return {'depth': depth, 'timestamp': timestamp, 'source': source, 'offset': offset}
+
+# BinaryTree over a binary file's counts, mapped copy-on-write so the
+# tree can still be changed without touching the file
+def loadBinary(filename):
+    header = readBinaryHeader(filename)
+    size = 2 ** (header['depth'] + 1)
+    values = np.memmap(filename, dtype='<i8', mode='c', offset=header['offset'], shape=(size,))
+    origValues = np.memmap(filename, dtype='<i8', mode='c', offset=header['offset'], shape=(size,))
+    return BinaryTree(levels=header['depth'], values=values, origValues=origValues)
+
+# BinaryTree weighted by a binary file or an ordered level file
+def loadTree(filename):
+    if isBinary(filename):
+        return loadBinary(filename)
+    counts = readLevel(filename)
+    depth = len(counts).bit_length() - 1
+    assert len(counts) == 2 ** depth
+    return BinaryTree(levels=depth, weights=counts)
+
 def main():
     parser = OptionParser()
     parser.add_option('-p', '--prefix', type='string', action='store', dest='prefix')
     parser.add_option('-f', '--file', type='string', action='store', dest='input')
     parser.add_option('-d', '--depth', type='int', action='store', dest='depth', default=8)
+    parser.add_option('-b', '--batch', action='store_true', dest='batch', default=False)
+    parser.add_option('-c', '--chunk', type='int', action='store', dest='chunk', default=2**20)
+    parser.add_option('-s', '--space', type='string', action='store', dest='space', default='0.0.0.0/0')
+    parser.add_option('-o', '--ordered', action='store_true', dest='ordered', default=False)
+    parser.add_option('-k', '--sketch', type='int', action='store', dest='capacity')
+    parser.add_option('-j', '--processes', type='int', action='store', dest='processes')
+    parser.add_option('-B', '--binary', action='store_true', dest='binary', default=False)
+    parser.add_option('-S', '--sparse', action='store_true', dest='sparse', default=False)
     (options, args) = parser.parse_args()
 
-    analyze(options.input, options.prefix, options.depth)
+    # Further trace files can follow the options in parallel mode
+    if options.sparse:
+        if options.ordered or options.binary:
+            parser.error('Sparse mode only writes largest-first level files')
+        analyzeSparse(options.input, options.prefix, options.depth, options.chunk, options.space)
+    elif options.processes is not None:
+        analyzeParallel([options.input] + args, options.prefix, options.depth, options.processes, space=options.space, ordered=options.ordered, binary=options.binary)
+    elif options.capacity is not None:
+        analyzeSketch(options.input, options.prefix, options.depth, options.capacity, options.chunk, options.space, options.ordered, options.binary)
+    elif options.batch or options.binary:
+        analyzeBatch(options.input, options.prefix, options.depth, options.chunk, options.space, options.ordered, options.binary)
+    else:
+        analyze(options.input, options.prefix, options.depth, options.space, options.ordered)
 
 if __name__ == '__main__':
     main()
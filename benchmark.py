@@ -0,0 +1,197 @@
+import sys
+import time
+import numpy as np
+from tree import *
+from allocate import *
+from analyze import readTrace, histogram, levelCounts
+from sketch import PrefixSketch
+from trie import SparseTree
+from workload import *
+from rebalance import Rebalancer, SimulatedCounters
+from help_lb import *
+from optparse import OptionParser
+
+# Times fn() and returns (seconds, result)
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return (time.time() - start, result)
+
+# Sorting one level with LoadNode.__cmp__ versus precomputed keys
+def benchLevelSort(options, max=4):
+    depth = options.depth
+    tree = RandomTree(levels=depth, max=max)
+    nodes = tree.level(depth)
+
+    (cmpTime, byCmp) = timed(lambda: sorted(nodes))
+    (keyTime, byKey) = timed(lambda: tree.sortedLevel(depth))
+    assert [n.value for n in byCmp] == list(tree.values[byKey])
+
+    print 'Level sort of %d nodes' % (len(nodes),)
+    print '  __cmp__:      %.4fs' % (cmpTime,)
+    print '  sort keys:    %.4fs' % (keyTime,)
+    print '  speedup:      %.1fx' % (cmpTime / keyTime,)
+
+# Greedy allocation of a random tree over servers of unequal weight
+def benchAllocate(options):
+    (depth, numServers) = (options.depth, options.servers)
+    tree = workloadTree(options, depth)
+    loads = range(1, numServers + 1)
+
+    (allocTime, rules) = timed(lambda: allocate(tree, loads))
+    got = ruleLoads(tree, rules)
+    total = float(tree.root.value)
+    error = max([abs(got.get(s, 0) - total * l / sum(loads)) / (total * l / sum(loads))
+                 for (l, s) in zip(loads, range(2, 2 + numServers))])
+
+    print 'Allocation of %d %s leaves over %d servers' % (2 ** depth, options.workload, numServers)
+    print '  time:         %.4fs' % (allocTime,)
+    print '  rules:        %d' % (len(rules),)
+    print '  max error:    %.4f%%' % (100 * error,)
+
+# Leaf weights of options.workload at depth
+def weights(options, depth):
+    return population(options.workload, depth, options.seed)
+
+# Random tree of options.workload at depth
+def workloadTree(options, depth):
+    if options.workload == 'zipf':
+        return ZipfTree(levels=depth, seed=options.seed)
+    if options.workload == 'hotspot':
+        return HotspotTree(levels=depth, seed=options.seed)
+    return RandomTree(levels=depth, seed=options.seed)
+
+# Client addresses from options.input, or options.clients drawn from
+# options.workload over space
+def clientIPs(options, space='0.0.0.0/0'):
+    if options.input is not None:
+        return np.concatenate(list(readTrace(options.input)))
+    depth = min(options.depth, 24, 32 - int(space.split('/')[1]))
+    return sampleIPs(weights(options, depth), options.clients, space, seed=options.seed)
+
+# Reactive per-client rules versus proactive wildcard rules, for clients
+# of the sandbox subnet load_balancer.py splits
+def benchProactive(options):
+    ips = [int(ip) for ip in clientIPs(options, SANDBOX_CLIENTS)]
+    modes = measure_proactive(ips, options.servers, space=SANDBOX_CLIENTS)
+
+    print 'Proactive mode for %d requests from %d clients over %d servers' % (len(ips), len(set(ips)), options.servers)
+    for mode in ['reactive', 'proactive']:
+        clients = modes[mode]['clients']
+        print '  %-10s packet-ins: %-8d rules: %-8d clients/server: %d..%d' % (
+            mode, modes[mode]['packet_ins'], modes[mode]['rules'],
+            min(clients.values()), max(clients.values()))
+    print '  packet-ins avoided: %d' % (modes['reactive']['packet_ins'] - modes['proactive']['packet_ins'],)
+
+# Heavy hitters of a bounded PrefixSketch against exact level counts
+def benchSketch(options, phi=0.01, capacity=256):
+    ips = clientIPs(options)
+    depth = min(options.depth, 32)
+    sketch = PrefixSketch(depth, capacity)
+    (sketchTime, _) = timed(lambda: [sketch.addIPs(chunk) for chunk in np.array_split(ips, max(len(ips) // 2**20, 1))])
+    (exactTime, levels) = timed(lambda: levelCounts(histogram(ips, depth), depth))
+
+    missed = 0
+    for l in range(1, depth + 1):
+        truth = set(np.flatnonzero(levels[l - 1] >= phi * len(ips)))
+        missed += len(truth - set([h[0] for h in sketch.heavyHitters(phi, [l])]))
+
+    print 'Prefix sketch of %d addresses to depth %d, %d counters per level' % (len(ips), depth, capacity)
+    print '  sketch:       %.4fs, %d bytes' % (sketchTime, sketch.memory())
+    print '  exact:        %.4fs, %d bytes' % (exactTime, sum([c.nbytes for c in levels]))
+    print '  max error:    %d (bound %d)' % (max(sketch.errors), len(ips) // (capacity + 1))
+    print '  hitters > %g missed: %d' % (phi, missed)
+
+# SparseTree over whole addresses, and allocation straight from it
+def benchSparse(options):
+    ips = clientIPs(options)
+    # Adding only queues the addresses; len() sorts them into the leaves
+    def build():
+        tree = SparseTree(levels=32, ips=ips)
+        len(tree)
+        return tree
+    (buildTime, tree) = timed(build)
+    (allocTime, prefixes) = timed(lambda: allocatePrefixes(tree, range(1, options.servers + 1)))
+
+    print 'Sparse /32 tree of %d addresses, %d distinct' % (len(ips), len(tree))
+    print '  build:        %.4fs, %d bytes (dense: %d bytes)' % (buildTime, tree.memory(), 2 ** 33 * 8)
+    print '  allocate:     %.4fs, %d rules over %d servers' % (allocTime, len(prefixes), options.servers)
+
+# Generation rates of the workload populations, traces and timelines
+def benchWorkload(options, steps=24):
+    depth = min(options.depth, 24)
+    for name in ['uniform', 'zipf', 'hotspot']:
+        (weightTime, w) = timed(lambda: population(name, depth, options.seed))
+        (traceTime, ips) = timed(lambda: sampleIPs(w, options.clients, seed=options.seed))
+        (sortedTime, ips) = timed(lambda: sampleIPs(w, options.clients, shuffle=False, seed=options.seed))
+        print 'Workload %s at depth %d, %d addresses' % (name, depth, options.clients)
+        print '  weights:      %.4fs, top leaf %.4f%%' % (weightTime, 100 * w.max())
+        print '  trace:        %.1fM/s (%.1fM/s unshuffled)' % (
+            len(ips) / traceTime / 1e6, len(ips) / sortedTime / 1e6)
+
+    w = population(options.workload, depth, options.seed)
+    (stepTime, total) = timed(lambda: sum([len(ips) for ips in sampleSteps(
+        timeline('both', w, steps, options.seed), options.clients // steps, seed=options.seed)]))
+    print 'Diurnal %s with a flash crowd over %d steps' % (options.workload, steps)
+    print '  trace:        %.1fM/s' % (total / stepTime / 1e6,)
+
+# Rebalancing 10.2.0.0/16 from an address split: first settling on
+# options.workload as is, then while it moves through a day of steps
+# polls and a flash crowd comes and goes
+def benchRebalance(options, settle=12, steps=240, requests=10 ** 6):
+    depth = min(options.depth, 16)
+    loads = range(1, options.servers + 1)
+    base = weights(options, depth)
+    ips = np.unique(sampleIPs(base, options.clients, '10.2.0.0/16', seed=options.seed)).astype(np.int64)
+    leaves = (ips & 0xffff) >> (16 - depth)
+
+    # A client's rate follows its leaf's weight relative to the start
+    source = SimulatedCounters(ips, seed=options.seed)
+    rebalancer = Rebalancer(source, loads, weights_to_prefixes(normalize(loads)), depth=depth)
+    phases = [('settle', timeline('static', base, settle)), ('day', timeline('both', base, steps, options.seed))]
+    print 'Rebalancing %d %s clients over %d servers' % (len(ips), options.workload, options.servers)
+    for (name, series) in phases:
+        (start, rebalances, changed) = (time.time(), rebalancer.rebalances, rebalancer.rulesChanged)
+        imbalances = []
+        for w in series:
+            source.setRates(requests * w[leaves] / base[leaves] / len(ips))
+            imbalances.append(rebalancer.step())
+        elapsed = time.time() - start
+        print '  %-7s %d steps, %.4fs per step, %d rebalances changing %d rules (of %d now)' % (
+            name + ':', len(imbalances), elapsed / len(imbalances), rebalancer.rebalances - rebalances,
+            rebalancer.rulesChanged - changed, len(rebalancer.prefixes))
+        print '           imbalance %.4f first, %.4f median, %.4f worst, %.4f last' % (
+            imbalances[0], np.median(imbalances), max(imbalances), imbalances[-1])
+
+benchmarks = {
+    'sort' : benchLevelSort,
+    'allocate' : benchAllocate,
+    'proactive' : benchProactive,
+    'sketch' : benchSketch,
+    'sparse' : benchSparse,
+    'workload' : benchWorkload,
+    'rebalance' : benchRebalance,
+}
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options] [' + '|'.join(sorted(benchmarks)) + ']')
+    parser.add_option('-d', '--depth', type='int', action='store', dest='depth', default=16)
+    parser.add_option('-s', '--servers', type='int', action='store', dest='servers', default=16)
+    parser.add_option('-f', '--file', type='string', action='store', dest='input')
+    parser.add_option('-n', '--clients', type='int', action='store', dest='clients', default=100000)
+    parser.add_option('-w', '--workload', type='string', action='store', dest='workload', default='uniform')
+    parser.add_option('-S', '--seed', type='int', action='store', dest='seed')
+    (options, args) = parser.parse_args()
+    if options.workload not in ['uniform', 'zipf', 'hotspot']:
+        parser.error('Unknown workload: ' + options.workload)
+
+    names = args
+    if len(names) == 0:
+        names = sorted(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            parser.error('Unknown benchmark: ' + name)
+        benchmarks[name](options)
+
+if __name__ == '__main__':
+    main()
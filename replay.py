@@ -0,0 +1,140 @@
+import sys
+import time
+import numpy as np
+from tree import *
+from allocate import allocatePrefixes
+from analyze import readTrace, histogram
+from help_lb import *
+from optparse import OptionParser
+
+# Offline replay of a client trace against load balancer rules. Every
+# request in the trace goes to the server of the rule matching its source
+# address, as the LB switch would send it, and the per-server counts are
+# compared with the target loads. Rules are (prefix_value, prefix_len,
+# server) integers within the client space, as weights_to_prefixes,
+# allocatePrefixes and param_lb.lb_prefixes hold them.
+
+# Every address of a trace file as one array
+def loadTrace(input, chunk=2**20):
+    return np.concatenate(list(readTrace(input, chunk)) + [np.zeros(0, dtype=np.uint32)])
+
+# (prefix_value, prefix_len, server) from nodes_to_rules/allocate rules
+def rulesToPrefixes(rules):
+    return [(int(b, 2) if b else 0, len(b), server) for (b, server) in rules]
+
+# Rule set file: one "prefix_value prefix_len server" line per rule
+def readRules(filename):
+    f = open(filename, 'r')
+    prefixes = [tuple([int(tok) for tok in line.split()]) for line in f if line.strip()]
+    f.close()
+    return prefixes
+
+# Number of requests in ips matched by each rule of prefixes, in order,
+# and the number matched by none
+def replay(ips, prefixes, space='0.0.0.0/0'):
+    (base, base_len) = space.split('/')
+    base = ipToInt(base)
+    base_len = int(base_len)
+    order = sorted(range(len(prefixes)), key=lambda r: prefixes[r][0] << (32 - base_len - prefixes[r][1]))
+    starts = np.array([base | (prefixes[r][0] << (32 - base_len - prefixes[r][1])) for r in order], dtype=np.int64)
+    ends = starts + np.array([1 << (32 - base_len - prefixes[r][1]) for r in order], dtype=np.int64)
+
+    ips = ips.astype(np.int64)
+    rules = np.searchsorted(starts, ips, side='right') - 1
+    matched = rules >= 0
+    matched[matched] = ips[matched] < ends[rules[matched]]
+    counts = np.bincount(rules[matched], minlength=len(prefixes))
+
+    result = np.zeros(len(prefixes), dtype=np.int64)
+    result[order] = counts
+    return (result, len(ips) - int(matched.sum()))
+
+# Replays ips against prefixes and reports the split they achieve
+def evaluate(ips, prefixes, loads, servers=None, space='0.0.0.0/0'):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    start = time.time()
+    (counts, unmatched) = replay(ips, prefixes, space)
+    runtime = time.time() - start
+
+    served = dict((s, 0) for s in servers)
+    for (p, c) in zip(prefixes, counts):
+        served[p[2]] = served.get(p[2], 0) + int(c)
+    return {'requests': len(ips), 'unmatched': unmatched, 'rules': len(prefixes),
+            'served': served, 'imbalance': load_imbalance(served, loads, servers),
+            'runtime': runtime}
+
+# Rule sets to compare for a trace, by name
+def addressRules(ips, loads, options):
+    return weights_to_prefixes(normalize(loads))
+
+def budgetRules(ips, loads, options):
+    (r, power, error) = budget_normalize(loads, options.rules)
+    return weights_to_prefixes(r)
+
+def trafficRules(ips, loads, options):
+    tree = BinaryTree(levels=options.depth, weights=histogram(ips, options.depth, options.space))
+    return allocatePrefixes(tree, loads)
+
+strategies = {
+    'address' : addressRules,
+    'budget' : budgetRules,
+    'traffic' : trafficRules,
+}
+
+def report(name, loads, result, servers=None):
+    if servers is None:
+        servers = range(2, 2 + len(loads))
+    total = float(max(result['requests'] - result['unmatched'], 1))
+    print '%s: %d rules, %d requests (%d unmatched), imbalance %.4f, replayed in %.4fs' % (
+        name, result['rules'], result['requests'], result['unmatched'],
+        result['imbalance'], result['runtime'])
+    for (l, s) in zip(loads, servers):
+        print '  server %-4d target %7.3f%%  served %7.3f%%  (%d)' % (
+            s, 100.0 * l / sum(loads), 100 * result['served'][s] / total, result['served'][s])
+
+def main():
+    parser = OptionParser(usage='Usage: %prog -f trace [options] [' + '|'.join(sorted(strategies)) + ']')
+    parser.add_option('-f', '--file', type='string', action='store', dest='input')
+    parser.add_option('-l', '--loads', type='string', action='store', dest='loads', default='1 1')
+    parser.add_option('-r', '--rules-file', type='string', action='store', dest='rulesFile')
+    parser.add_option('-b', '--budget', type='int', action='store', dest='rules', default=16)
+    parser.add_option('-d', '--depth', type='int', action='store', dest='depth', default=16)
+    parser.add_option('-s', '--space', type='string', action='store', dest='space', default='0.0.0.0/0')
+    parser.add_option('-t', '--threshold', type='float', action='store', dest='threshold')
+    (options, args) = parser.parse_args()
+    if options.input is None:
+        parser.error('No trace given')
+
+    # Loads as in loads.txt: a file of space-separated weights, or the weights
+    try:
+        f = open(options.loads, 'r')
+        loads = [int(x) for x in f.readline().split()]
+        f.close()
+    except IOError:
+        loads = [int(x) for x in options.loads.split()]
+
+    start = time.time()
+    ips = loadTrace(options.input)
+    print 'Loaded %d requests in %.4fs' % (len(ips), time.time() - start)
+
+    results = {}
+    if options.rulesFile is not None:
+        results['file'] = evaluate(ips, readRules(options.rulesFile), loads, space=options.space)
+        report(options.rulesFile, loads, results['file'])
+    names = args
+    if len(names) == 0 and options.rulesFile is None:
+        names = sorted(strategies)
+    for name in names:
+        if name not in strategies:
+            parser.error('Unknown strategy: ' + name)
+        results[name] = evaluate(ips, strategies[name](ips, loads, options), loads, space=options.space)
+        report(name, loads, results[name])
+
+    # Nonzero exit when any rule set misses the threshold, for CI
+    if options.threshold is not None:
+        if max([r['imbalance'] for r in results.values()]) > options.threshold:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
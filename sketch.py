@@ -0,0 +1,156 @@
+import numpy as np
+from tree import *
+
+# Streaming heavy-hitter counts of client prefixes in bounded memory.
+#
+# Every level 1..depth keeps a Misra-Gries summary of at most capacity
+# prefixes. Addresses are added in batches: each batch is counted exactly
+# per level and merged into the summary, and when a level overflows the
+# (capacity+1)-th largest count is taken off every counter and the ones
+# left at zero are dropped. A stored count never exceeds the true count
+# and falls short of it by at most errors[level], which is itself at most
+# total / (capacity + 1). So every prefix above a share phi of traffic is
+# found once capacity >= 1 / phi, in depth * capacity counters.
+
+class PrefixSketch:
+    '''
+    Misra-Gries summaries of the prefixes of client addresses at every
+    depth. Prefixes are taken from the bits after space's own prefix,
+    as in analyze.py.
+    '''
+
+    def __init__(self, depth=16, capacity=1024, space='0.0.0.0/0'):
+        (base, base_len) = space.split('/')
+        self.depth = depth
+        self.capacity = capacity
+        self.base = ipToInt(base)
+        self.baseLen = int(base_len)
+        assert self.baseLen + depth <= 32
+
+        self.total = 0
+        # Index 0 is unused so that level l sits at l
+        self.keys = [np.zeros(0, dtype=np.int64) for l in range(depth + 1)]
+        self.counts = [np.zeros(0, dtype=np.int64) for l in range(depth + 1)]
+        self.errors = np.zeros(depth + 1, dtype=np.int64)
+
+    # Counters in use and the bytes they take
+    def size(self):
+        return sum([len(k) for k in self.keys])
+
+    def memory(self):
+        return sum([k.nbytes + c.nbytes for (k, c) in zip(self.keys, self.counts)])
+
+    # Adds an array of 32-bit addresses, ignoring any outside the space
+    def addIPs(self, ips):
+        ips = np.asarray(ips, dtype=np.int64)
+        if self.baseLen > 0:
+            shift = 32 - self.baseLen
+            ips = ips[(ips >> shift) == (self.base >> shift)]
+        if len(ips) == 0:
+            return
+        leaves = np.sort((ips & ((1 << (32 - self.baseLen)) - 1)) >> (32 - self.baseLen - self.depth))
+        self.total += len(leaves)
+
+        # Prefixes of sorted leaves stay sorted, so runs give exact counts
+        for l in range(self.depth, 0, -1):
+            prefixes = leaves >> (self.depth - l)
+            starts = np.flatnonzero(np.concatenate([[True], prefixes[1:] != prefixes[:-1]]))
+            counts = np.diff(np.append(starts, len(prefixes)))
+            self._merge(l, prefixes[starts], counts)
+
+    def addIP(self, ip):
+        self.addIPs([ipToInt(ip)])
+
+    def _merge(self, l, keys, counts):
+        keys = np.concatenate([self.keys[l], keys])
+        counts = np.concatenate([self.counts[l], counts])
+        (keys, inverse) = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, weights=counts).astype(np.int64)
+
+        if len(keys) > self.capacity:
+            cut = np.partition(counts, len(counts) - self.capacity - 1)[len(counts) - self.capacity - 1]
+            counts -= cut
+            self.errors[l] += cut
+            kept = counts > 0
+            (keys, counts) = (keys[kept], counts[kept])
+        (self.keys[l], self.counts[l]) = (keys, counts)
+
+    # (lower, upper) bounds on the traffic of prefix value of length l
+    def estimate(self, value, l):
+        if l == 0:
+            return (self.total, self.total)
+        i = np.searchsorted(self.keys[l], value)
+        lower = 0
+        if i < len(self.keys[l]) and self.keys[l][i] == value:
+            lower = int(self.counts[l][i])
+        return (lower, lower + int(self.errors[l]))
+
+    # Every (prefix_value, prefix_len, lower, upper) that may carry at
+    # least a share phi of the traffic, largest first. No prefix above
+    # phi is missed; those with lower >= phi * total certainly are.
+    def heavyHitters(self, phi, levels=None):
+        if levels is None:
+            levels = range(1, self.depth + 1)
+        hitters = []
+        for l in levels:
+            upper = self.counts[l] + self.errors[l]
+            for i in np.flatnonzero(upper >= phi * self.total):
+                hitters.append((int(self.keys[l][i]), l, int(self.counts[l][i]), int(upper[i])))
+        hitters.sort(key=lambda h: (-h[2], h[1], h[0]))
+        return hitters
+
+    # Prefixes that are hot in their own right, deepest first: a prefix
+    # counts once its traffic not already in a hot descendant is surely
+    # above phi. Splitting exactly these separates the hot spots.
+    # Returns (prefix_value, prefix_len, own traffic).
+    def hotPrefixes(self, phi):
+        hot = []
+        claimed = {} # prefix --> traffic in its hot descendants
+        for l in range(self.depth, 0, -1):
+            parents = {}
+            for (key, count) in zip(self.keys[l], self.counts[l]):
+                (key, count) = (int(key), int(count))
+                rest = count - claimed.pop(key, 0)
+                if rest >= phi * self.total:
+                    hot.append((key, l, rest))
+                    parents[key >> 1] = parents.get(key >> 1, 0) + count
+                else:
+                    parents[key >> 1] = parents.get(key >> 1, 0) + count - rest
+            for (key, count) in claimed.items(): # Hot descendants of dropped prefixes
+                parents[key >> 1] = parents.get(key >> 1, 0) + count
+            claimed = parents
+        return hot
+
+    # BinaryTree of estimated counts down to depth. Tracked prefixes get
+    # their lower bound and whatever of a parent's count is not in a
+    # tracked child is spread evenly over its untracked children, so
+    # cold space stays uniform and aggregates under allocate.py while
+    # hot prefixes keep their own weight.
+    def toTree(self, depth=None):
+        if depth is None:
+            depth = self.depth
+        assert depth <= self.depth
+        level = np.array([float(self.total)])
+        for l in range(1, depth + 1):
+            known = np.zeros(2 ** l)
+            tracked = np.zeros(2 ** l, dtype=np.bool_)
+            known[self.keys[l]] = self.counts[l]
+            tracked[self.keys[l]] = True
+
+            # Tracked children can not hold more than their parent
+            pairs = known.reshape(-1, 2)
+            held = pairs.sum(axis=1)
+            over = held > level
+            pairs[over] *= (level[over] / held[over])[:, None]
+            rest = level - pairs.sum(axis=1)
+
+            free = (~tracked).reshape(-1, 2)
+            numFree = free.sum(axis=1)
+            share = np.where(numFree > 0, rest / np.maximum(numFree, 1), 0.0)
+            pairs += free * share[:, None]
+            # Both tracked: hand the rest out like the tracked counts
+            both = (numFree == 0) & (rest > 0)
+            split = np.where(held[both] > 0, pairs[both][:, 0] / np.maximum(pairs[both].sum(axis=1), 1e-12), 0.5)
+            pairs[both] += np.stack([split, 1 - split], axis=1) * rest[both][:, None]
+            level = pairs.reshape(-1)
+        return BinaryTree(levels=depth, weights=np.rint(level).astype(np.int64))
@@ -1,46 +1,96 @@
 import random
+import numpy as np
 from help_lb import normalize
 
-def uncommonAncestor(one, two):
-    one2root = []
-    two2root = []
+# Nodes are stored heap-style in flat arrays: the root is index 1 and
+# node i has children 2i and 2i+1. A node's depth, name and parent all
+# follow from its index, so nothing but the counts needs to be stored.
+
+def depthOf(index):
+    return index.bit_length() - 1
+
+# Converts a dotted-quad string (or an int already) to a 32-bit int
+def ipToInt(ip):
+    if isinstance(ip, basestring):
+        octets = [int(tok) for tok in ip.strip().strip(':').split('.')]
+        return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+    return int(ip)
 
-    if one is two:
+def uncommonAncestor(one, two):
+    if one.tree is two.tree and one.index == two.index:
         return (one, two)
 
-    n = one
-    one2root.append(n)
-    while n.parent is not None:
-        n = n.parent
-        one2root.append(n)
-    n = two
-    two2root.append(n)
-    while n.parent is not None:
-        n = n.parent
-        two2root.append(n)
-
-    n1 = one2root.pop()
-    n2 = two2root.pop()
-    while n1 is n2 and len(one2root) > 0 and len(two2root) > 0:
-        n1 = one2root.pop()
-        n2 = two2root.pop()
-    return (n1, n2)
-
-class LoadNode():
+    # Walk both root-to-node paths until they diverge
+    d1 = depthOf(one.index)
+    d2 = depthOf(two.index)
+    k = 0
+    i1 = one.index >> d1
+    i2 = two.index >> d2
+    while i1 == i2 and k < d1 and k < d2:
+        k += 1
+        i1 = one.index >> (d1 - k)
+        i2 = two.index >> (d2 - k)
+    return (one.tree.node(i1), two.tree.node(i2))
+
+class LoadNode(object):
     '''
-    Class of nodes. Value (cached) is the sum of its children's values.
+    View of a single node of a BinaryTree. Value (cached) is the sum of
+    its children's values.
     '''
-    def __init__(self, value=0, parent=None):
-        self.value = value
-        self.origValue = value
-        self.name = ''
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index=1):
+        self.tree = tree
+        self.index = index
+
+    def _getValue(self):
+        return int(self.tree.values[self.index])
+    def _setValue(self, value):
+        self.tree.values[self.index] = value
+        self.tree.rankDepth = 0
+    value = property(_getValue, _setValue)
+
+    def _getOrigValue(self):
+        return int(self.tree.origValues[self.index])
+    def _setOrigValue(self, value):
+        self.tree.origValues[self.index] = value
+    origValue = property(_getOrigValue, _setOrigValue)
+
+    @property
+    def used(self):
+        return bool(self.tree.used[self.index])
+
+    @property
+    def depth(self):
+        return depthOf(self.index)
 
-        self.parent = parent
-        self.left = None
-        self.right = None
-        self.sibling = None
+    @property
+    def name(self):
+        return bin(self.index)[3:] # Drop '0b' and the root's leading 1
 
-        self.used = False
+    @property
+    def parent(self):
+        if self.index == 1:
+            return None
+        return LoadNode(self.tree, self.index >> 1)
+
+    @property
+    def left(self):
+        if self.isLeaf():
+            return None
+        return LoadNode(self.tree, self.index << 1)
+
+    @property
+    def right(self):
+        if self.isLeaf():
+            return None
+        return LoadNode(self.tree, (self.index << 1) | 1)
+
+    @property
+    def sibling(self):
+        if self.index == 1:
+            return None
+        return LoadNode(self.tree, self.index ^ 1)
 
     # Specifically for greedy algorithms used with heapq
     # which is a minPQ.
@@ -50,135 +100,248 @@ class LoadNode():
         else: # Break ties by value of 1st uncommon ancestor
             (one, two) = uncommonAncestor(self, other)
             return two.value - one.value
+
+    # Sort key that orders like __cmp__ within a depth without walking
+    # ancestors. Only valid until the tree's values next change.
+    @property
+    def key(self):
+        return self.tree.key(self.index)
+
     def __str__(self):
         return str((self.name, self.value))
     def __repr__(self):
         return self.__str__()
 
     def isLeaf(self):
-        return self.left is None and self.right is None
+        return self.depth == self.tree.levels
 
     def update(self):
-        if self.left is None and self.right is None:
-            return
-        self.value = 0
-        if self.left is not None:
-            self.left.update()
-            self.value += self.left.value
-        if self.right is not None:
-            self.right.update()
-            self.value += self.right.value
-
-#    def makeTree(self, levels):
-#        assert levels >= 0
-#        if levels == 0:
-#            return self
-#        self.left = LoadNode(parent=self)
-#        self.left.makeTree(levels - 1)
-#        self.right = LoadNode(parent=self)
-#        self.right.makeTree(levels - 1)
+        self.tree.update(self.index)
 
+    # Names are derived from the index, so there is nothing to build
     def makeNames(self):
-        if self.parent is None:
-            self.name = ''
-        if self.left is not None:
-            self.left.name = self.name + '0'
-            self.left.makeNames()
-        if self.right is not None:
-            self.right.name = self.name + '1'
-            self.right.makeNames()
+        pass
 
     def markUsed(self):
-        self.used = True
-        self.value = 0
-        if self.left is not None:
-            self.left.markUsed()
-        if self.right is not None:
-            self.right.markUsed()
+        self.tree.markUsed(self.index)
 
 class BinaryTree:
     '''
     Class for creating a binary tree
     '''
 
-    def __init__(self, levels=1, weights=None):
-        self.root = LoadNode()
-        if levels > 0:
-            leftTree = BinaryTree(levels - 1)
-            self.root.left = leftTree.root
-            self.root.left.parent = self.root
+    # values (and origValues) can instead give every node's count in heap
+    # order, e.g. a memory-mapped file, which is then used as is
+    def __init__(self, levels=1, weights=None, values=None, origValues=None):
+        assert levels >= 0
+        self.levels = levels
+        self.shifts = np.arange(levels + 1)
 
-            rightTree = BinaryTree(levels - 1)
-            self.root.right = rightTree.root
-            self.root.right.parent = self.root
+        # Index 0 is unused so that the root sits at 1
+        size = 2 ** (levels + 1)
+        self.values = np.zeros(size, dtype=np.int64)
+        self.used = np.zeros(size, dtype=np.bool_)
 
-            self.root.left.sibling = self.root.right
-            self.root.right.sibling = self.root.left
+        if values is not None:
+            assert len(values) == size
+            self.values = values
+            self.origValues = origValues if origValues is not None else values.copy()
+        elif weights is not None:
+            assert len(weights) == (2 ** levels)
+            self.values[2 ** levels:] = weights
+            self.update()
+            self.origValues = self.values.copy()
+        else:
+            self.origValues = np.zeros(size, dtype=np.int64)
 
-        self.root.makeNames()
+        # Tie-break ranks for sort keys, computed lazily down to rankDepth
+        self.ranks = np.zeros(size, dtype=np.int64)
+        self.rankDepth = 0
 
-        if weights is not None:
-            assert len(weights) == (2 ** levels)
-            leaves = self.leaves()
-            for l, w in zip(leaves, weights):
-                l.value = w
-                l.origValue = w
-            self.root.update()
+    @property
+    def root(self):
+        return LoadNode(self, 1)
+
+    def node(self, index):
+        return LoadNode(self, index)
+
+    # Index range [lo, hi) of the descendants of index at depth
+    def _span(self, index, depth):
+        shift = depth - depthOf(index)
+        return (index << shift, (index + 1) << shift)
 
     # The leaves of this tree
     def leaves(self, root=None, l=None):
-        # Initialize
         if root is None:
             root = self.root
         if l is None:
             l = []
 
-        if root.isLeaf():
-            l.append(root)
-            return l
-        if root.left is not None:
-            l = self.leaves(root=root.left, l=l)
-        if root.right is not None:
-            l = self.leaves(root=root.right, l=l)
+        (lo, hi) = self._span(root.index, self.levels)
+        l.extend(LoadNode(self, i) for i in xrange(lo, hi))
         return l
 
     def level(self, depth, prev=None):
         if prev is None:
             prev = [self.root]
-        if depth == 0:
-            return prev
-        else:
-            prev2 = []
-            for node in prev:
-                if node.left is not None:
-                    prev2.append(node.left)
-                if node.right is not None:
-                    prev2.append(node.right)
-            prev = prev2
-            return self.level(depth - 1, prev)
+        nodes = []
+        for node in prev:
+            (lo, hi) = self._span(node.index, node.depth + depth)
+            nodes.extend(LoadNode(self, i) for i in xrange(lo, hi))
+        return nodes
 
     def insert(self, binStr, root=None):
         if root is None:
             root = self.root
+        self.rankDepth = 0
+
+        i = root.index
+        self.values[i] += 1
+        for bit in binStr:
+            i = (i << 1) | (bit == '1')
+            self.values[i] += 1
+
+    # Heap index of the leaf covering a 32-bit address
+    def leafIndex(self, ip):
+        return (1 << self.levels) | (ipToInt(ip) >> (32 - self.levels))
+
+    # Adds delta to a leaf (numbered left to right from 0) and each of
+    # its ancestors. Used nodes keep a value of 0 but still record the
+    # load in origValue.
+    def addLeaf(self, leaf, delta=1):
+        self.rankDepth = 0
+        path = ((1 << self.levels) | leaf) >> self.shifts
+        self.origValues[path] += delta
+        self.values[path] += delta * ~self.used[path]
+
+    def addIP(self, ip, delta=1):
+        self.addLeaf(ipToInt(ip) >> (32 - self.levels), delta)
+
+    # Batched addIP over a sequence of (ip, delta) pairs
+    def addMany(self, pairs):
+        if len(pairs) == 0:
+            return
+        self.rankDepth = 0
+        (ips, deltas) = zip(*pairs)
+        if isinstance(ips[0], basestring):
+            ips = [ipToInt(ip) for ip in ips]
+        ips = np.array(ips, dtype=np.int64)
+        deltas = np.array(deltas, dtype=np.int64)
+
+        # Sort once so that equal ancestors stay adjacent at every level
+        idx = (ips >> (32 - self.levels)) | (1 << self.levels)
+        order = np.argsort(idx, kind='mergesort')
+        idx = idx[order]
+        deltas = deltas[order]
+        for depth in range(self.levels, -1, -1):
+            starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+            idx = idx[starts]
+            deltas = np.add.reduceat(deltas, starts)
+            self.origValues[idx] += deltas
+            self.values[idx] += deltas * ~self.used[idx]
+            idx >>= 1
+
+    # Adds delta to the subtree at index when only its total is known,
+    # e.g. from a per-rule counter. The leaves get shares in proportion to
+    # their current values (evenly if those are all 0) and the total is
+    # pushed up to the root.
+    def addPrefix(self, index, delta):
+        if delta <= 0:
+            return
+        self.rankDepth = 0
+        (lo, hi) = self._span(index, self.levels)
+        weights = self.origValues[lo:hi].astype(float)
+        if weights.sum() <= 0:
+            weights = np.ones(hi - lo)
+        share = delta * weights / weights.sum()
+        parts = np.floor(share).astype(np.int64)
+        left = delta - int(parts.sum())
+        parts[np.argsort(parts - share, kind='mergesort')[:left]] += 1
+
+        self.origValues[lo:hi] += parts
+        self.values[lo:hi] += parts * ~self.used[lo:hi]
+        self._resum(self.origValues, index)
+        self._resum(self.values, index)
+        path = index >> self.shifts[1:depthOf(index) + 1]
+        self.origValues[path] += delta
+        self.values[path] += delta * ~self.used[path]
+
+    # Multiplies every leaf by factor, rounding down, and re-sums, so
+    # that older measurements fade
+    def scale(self, factor):
+        self.rankDepth = 0
+        (lo, hi) = self._span(1, self.levels)
+        for counts in (self.values, self.origValues):
+            counts[lo:hi] = (counts[lo:hi] * factor).astype(np.int64)
+            self._resum(counts, 1)
+
+    def _resum(self, counts, index):
+        for depth in range(self.levels - 1, depthOf(index) - 1, -1):
+            (lo, hi) = self._span(index, depth)
+            counts[lo:hi] = counts[2 * lo:2 * hi:2] + counts[2 * lo + 1:2 * hi:2]
+
+    # Recomputes the cached sums below index from the leaves up
+    def update(self, index=1):
+        self.rankDepth = 0
+        self._resum(self.values, index)
 
-        root.value += 1
-        if len(binStr) > 0 and binStr[0] == '0':
-            self.insert(binStr[1:], root.left)
-        elif len(binStr) > 0 and binStr[0] == '1':
-            self.insert(binStr[1:], root.right)
+    def markUsed(self, index=1):
+        self.rankDepth = 0
+        for depth in range(depthOf(index), self.levels + 1):
+            (lo, hi) = self._span(index, depth)
+            self.used[lo:hi] = True
+            self.values[lo:hi] = 0
+
+    # Ranks every node at depths 1..depth by the values along its path
+    # from the root, largest first. Two nodes at the same depth compare
+    # by rank the way __cmp__ compares their first uncommon ancestors.
+    def rankPaths(self, depth):
+        for d in range(self.rankDepth + 1, depth + 1):
+            (lo, hi) = (2 ** d, 2 ** (d + 1))
+            parents = self.ranks[lo >> 1:hi >> 1].repeat(2)
+            order = np.lexsort((-self.values[lo:hi], parents))
+            keys = (parents[order], self.values[lo:hi][order])
+            changed = np.r_[False, (keys[0][1:] != keys[0][:-1]) |
+                                   (keys[1][1:] != keys[1][:-1])]
+            self.ranks[lo + order] = np.cumsum(changed)
+        self.rankDepth = max(self.rankDepth, depth)
+
+    # (-value, depth, path rank, index). Ranks only compare within a
+    # depth, so ascending order matches __cmp__ for nodes of one depth;
+    # equal values at different depths go shallowest first.
+    def key(self, index):
+        depth = depthOf(index)
+        self.rankPaths(depth)
+        return (-int(self.values[index]), depth, int(self.ranks[index]), index)
+
+    # Indices of the nodes at depth in __cmp__ order
+    def sortedLevel(self, depth):
+        self.rankPaths(depth)
+        (lo, hi) = (2 ** depth, 2 ** (depth + 1))
+        order = np.lexsort((self.ranks[lo:hi], -self.values[lo:hi]))
+        return order + lo
 
 class RandomTree(BinaryTree):
     '''
     Creates a balanced binary tree with random leaf values
     '''
 
-    def __init__(self, levels=1, max=100, normal=None):
+    # Without a seed the draws follow the random module's state, so
+    # random.seed() still makes trees reproducible
+    def __init__(self, levels=1, max=100, normal=None, seed=None):
         numLeaves = 2 ** levels
-        values = [random.randint(0, max) for i in range(numLeaves)]
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.max = max
+        values = self.leafWeights(numLeaves, np.random.RandomState(seed))
         if normal is not None:
-            values = normalize(values, normal)
+            values = normalize(np.asarray(values).tolist(), normal)
+
+        BinaryTree.__init__(self, levels=levels, weights=values)
+
+    # Leaf values, left to right; subclasses draw other distributions
+    def leafWeights(self, numLeaves, random):
+        return random.randint(0, self.max + 1, numLeaves)
 
-        tree = BinaryTree(levels=levels, weights=values)
-        self.root = tree.root
 
 
@@ -0,0 +1,202 @@
+import numpy as np
+from tree import *
+
+# Sparse, read-only variant of BinaryTree for deep trees such as full
+# /32 client addresses, in memory proportional to the distinct leaves.
+#
+# Only observed leaves are stored, as a sorted array with their counts
+# and a running sum of them. Nodes are named by the heap index they have
+# in a BinaryTree of the same depth, and the count under any node is the
+# difference of the running sum at the ends of its leaf range.
+#
+# What it supports is the counting side of BinaryTree: adding addresses,
+# node values through values/origValues and LoadNode, key (ties broken
+# by position, not path), and so allocateNodes, allocate and
+# allocatePrefixes. leaves() only lists nonempty leaves. Nothing is ever
+# used, and markUsed or assigning a node value raises TypeError; use
+# toBinaryTree for code that consumes the tree.
+
+class SubtreeSums(object):
+    '''
+    Read-only stand-in for BinaryTree.values: the count under any heap
+    index (or array of them), computed from the leaves on demand.
+    '''
+    __slots__ = ('tree',)
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def __getitem__(self, index):
+        return self.tree.subtreeSum(index)
+
+    def __setitem__(self, index, value):
+        raise TypeError('SparseTree counts are read-only; use toBinaryTree() to change them')
+
+    def __len__(self):
+        return 2 ** (self.tree.levels + 1)
+
+class NeverUsed(object):
+    '''
+    Stand-in for BinaryTree.used: no node of a SparseTree is used.
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0:
+            return False
+        return np.zeros(np.shape(index), dtype=np.bool_)
+
+class SparseTree:
+    '''
+    Counts of levels-bit leaves (32 for whole addresses) that only
+    stores the leaves seen. See the notes above for what it supports.
+    '''
+
+    def __init__(self, levels=32, ips=None):
+        assert 0 <= levels <= 32
+        self.levels = levels
+        # Leaves seen in order, their counts and the running sum of those
+        self.seen = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(1, dtype=np.int64)
+        self.pending = []
+        self.values = SubtreeSums(self)
+        self.origValues = self.values
+        self.used = NeverUsed()
+        if ips is not None:
+            self.addIPs(ips)
+
+    def __len__(self):
+        self._compact()
+        return len(self.seen)
+
+    def memory(self):
+        self._compact()
+        return self.seen.nbytes + self.counts.nbytes + self.sums.nbytes
+
+    @property
+    def root(self):
+        return LoadNode(self, 1)
+
+    def node(self, index):
+        return LoadNode(self, index)
+
+    # Sort key like BinaryTree.key, breaking ties by position
+    def key(self, index):
+        return (-int(self.subtreeSum(index)), depthOf(index), 0, index)
+
+    # Adds delta to a leaf (numbered left to right from 0)
+    def addLeaf(self, leaf, delta=1):
+        self.pending.append((np.array([leaf], dtype=np.int64), np.array([delta], dtype=np.int64)))
+
+    def addIP(self, ip, delta=1):
+        self.addLeaf(ipToInt(ip) >> (32 - self.levels), delta)
+
+    # Adds an array of 32-bit addresses, with optional per-address deltas
+    def addIPs(self, ips, deltas=None):
+        leaves = np.asarray(ips, dtype=np.int64) >> (32 - self.levels)
+        if deltas is None:
+            deltas = np.ones(len(leaves), dtype=np.int64)
+        self.pending.append((leaves, np.asarray(deltas, dtype=np.int64)))
+
+    # Batched addIP over a sequence of (ip, delta) pairs
+    def addMany(self, pairs):
+        pairs = list(pairs)
+        self.addIPs([ipToInt(ip) for (ip, delta) in pairs], [delta for (ip, delta) in pairs])
+
+    # Counts a prefix of up to levels bits below root, as BinaryTree.insert
+    # does. Shorter prefixes are counted at their first leaf: nodes at or
+    # above the prefix get the same sums, but below it the count lands on
+    # the leftmost path down to that leaf, where BinaryTree has none.
+    def insert(self, binStr, root=None):
+        if root is None:
+            root = self.root
+        depth = root.depth + len(binStr)
+        assert depth <= self.levels
+        index = (root.index << len(binStr)) | (int(binStr, 2) if binStr else 0)
+        self.addLeaf(self.span(index)[0])
+
+    # Sums are always current, so there is nothing to recompute
+    def update(self, index=1):
+        pass
+
+    def markUsed(self, index=1):
+        raise TypeError('SparseTree nodes can not be marked used; use toBinaryTree()')
+
+    # Folds pending additions into the sorted leaves
+    def _compact(self):
+        if len(self.pending) == 0:
+            return
+        leaves = np.concatenate([self.seen] + [p[0] for p in self.pending])
+        counts = np.concatenate([self.counts] + [p[1] for p in self.pending])
+        self.pending = []
+        if len(leaves) == 0:
+            return
+        # Summed in int64 (bincount would go through float64)
+        order = np.argsort(leaves, kind='mergesort')
+        (leaves, counts) = (leaves[order], counts[order])
+        starts = np.flatnonzero(np.r_[True, leaves[1:] != leaves[:-1]])
+        self.seen = leaves[starts]
+        self.counts = np.add.reduceat(counts, starts)
+        self.sums = np.concatenate([[0], np.cumsum(self.counts)])
+
+    # Leaf range [lo, hi) under heap index (or an array of them)
+    def span(self, index):
+        index = np.asarray(index, dtype=np.int64)
+        if index.ndim == 0:
+            shift = self.levels - depthOf(int(index))
+        else:
+            shift = self.levels - (np.frexp(index.astype(float))[1] - 1)
+        lo = (index << shift) - (np.int64(1) << self.levels)
+        return (lo, lo + (np.int64(1) << shift))
+
+    def subtreeSum(self, index):
+        self._compact()
+        (lo, hi) = self.span(index)
+        total = self.sums[np.searchsorted(self.seen, hi)] - self.sums[np.searchsorted(self.seen, lo)]
+        if np.ndim(total) == 0:
+            return int(total)
+        return total
+
+    # (heap indices, counts) of the nonempty nodes at depth
+    def levelCounts(self, depth):
+        self._compact()
+        prefixes = self.seen >> (self.levels - depth)
+        if len(prefixes) == 0:
+            return (prefixes, self.counts)
+        starts = np.flatnonzero(np.concatenate([[True], prefixes[1:] != prefixes[:-1]]))
+        counts = np.add.reduceat(self.counts, starts)
+        return ((np.int64(1) << depth) | prefixes[starts], counts)
+
+    # Every node depth levels below each of prev (the root by default),
+    # empty or not, as BinaryTree.level. For deep levels of a sparse
+    # tree, levelCounts lists just the nonempty ones.
+    def level(self, depth, prev=None):
+        if prev is None:
+            prev = [self.root]
+        nodes = []
+        for node in prev:
+            index = node.index << depth
+            assert node.depth + depth <= self.levels
+            nodes.extend(LoadNode(self, i) for i in xrange(index, index + 2 ** depth))
+        return nodes
+
+    # Nonempty leaves under root, left to right, appended to l
+    def leaves(self, root=None, l=None):
+        if root is None:
+            root = self.root
+        if l is None:
+            l = []
+        self._compact()
+        (lo, hi) = self.span(root.index)
+        (start, end) = np.searchsorted(self.seen, [lo, hi])
+        first = np.int64(1) << self.levels
+        l.extend(LoadNode(self, int(first | leaf)) for leaf in self.seen[start:end])
+        return l
+
+    # Dense BinaryTree of the top depth levels, for code that wants one
+    def toBinaryTree(self, depth):
+        (indices, counts) = self.levelCounts(depth)
+        weights = np.zeros(2 ** depth, dtype=np.int64)
+        weights[indices - (1 << depth)] = counts
+        return BinaryTree(levels=depth, weights=weights)
@@ -0,0 +1,229 @@
+import time
+import numpy as np
+from tree import *
+from optparse import OptionParser
+
+# Synthetic client populations for the allocation and rebalancing
+# benchmarks, drawn with numpy in bulk rather than a leaf at a time.
+#
+# Weights are arrays of 2 ** levels floats, the relative traffic of every
+# prefix of length levels left to right, as RandomTree's leaves. Static
+# populations come from zipfWeights (popular prefixes scattered over the
+# space) and hotspotWeights (traffic clustered around a few addresses).
+# diurnal and flashCrowd turn one population into a sequence over time.
+# sampleCounts turns weights into integer leaf counts for a tree, and
+# sampleIPs into a trace of client addresses in a space. Every generator
+# takes a seed, or a numpy RandomState to share one across calls.
+
+def randomState(seed=None):
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
+
+def uniformWeights(levels):
+    return np.ones(2 ** levels) / 2 ** levels
+
+# Prefix of rank r (from 1) gets traffic proportional to r ** -exponent,
+# the ranks shuffled over the leaves
+def zipfWeights(levels, exponent=1.0, seed=None):
+    random = randomState(seed)
+    weights = np.arange(1, 2 ** levels + 1, dtype=float) ** -exponent
+    weights = weights[random.permutation(2 ** levels)]
+    return weights / weights.sum()
+
+# Bell of unit mass over numLeaves leaves around center, wrapping at the
+# ends, cut off at 4 widths
+def spot(numLeaves, center, width):
+    reach = int(4 * width)
+    if 2 * reach + 1 >= numLeaves:
+        offsets = np.arange(numLeaves) - center
+        offsets = (offsets + numLeaves // 2) % numLeaves - numLeaves // 2
+        leaves = np.arange(numLeaves)
+    else:
+        offsets = np.arange(-reach, reach + 1)
+        leaves = (center + offsets) % numLeaves
+    bell = np.exp(-0.5 * (offsets / float(max(width, 1e-9))) ** 2)
+    weights = np.zeros(numLeaves)
+    weights[leaves] = bell / bell.sum()
+    return weights
+
+# share of the traffic in spots clusters at random centers, the rest
+# spread evenly. Cluster sizes fall off as rank ** -exponent and each
+# spreads over about width leaves (default 1/256 of the space).
+def hotspotWeights(levels, spots=8, share=0.8, width=None, exponent=1.0, seed=None):
+    random = randomState(seed)
+    numLeaves = 2 ** levels
+    if width is None:
+        width = max(numLeaves / 256.0, 1.0)
+    sizes = np.arange(1, spots + 1, dtype=float) ** -exponent
+    sizes *= share / sizes.sum()
+
+    weights = np.ones(numLeaves) * (1 - share) / numLeaves
+    for (center, size) in zip(random.randint(0, numLeaves, spots), sizes):
+        weights += size * spot(numLeaves, center, width)
+    return weights / weights.sum()
+
+# Yields the weights of steps intervals of a day of period steps. The
+# space is split into regions equal blocks, like time zones, whose
+# traffic peaks in turn at 1 + amplitude times their mean. Totals vary
+# over the day, so sums are relative to the sum of weights.
+def diurnal(weights, steps, period=None, amplitude=0.8, regions=8):
+    if period is None:
+        period = steps
+    region = np.arange(len(weights)) * regions // len(weights)
+    for t in range(steps):
+        phase = 2 * np.pi * (float(t) / period - region / float(regions))
+        yield weights * (1 + amplitude * np.cos(phase))
+
+# Passes a sequence of weights through, adding a crowd around center of
+# magnitude times their average total at its peak. It builds up over
+# rise steps from start and then decays by half every halfLife steps.
+def flashCrowd(series, start, center=None, width=1.0, magnitude=4.0, rise=1, halfLife=2.0, seed=None):
+    random = randomState(seed)
+    (crowd, scale) = (None, None)
+    for (t, weights) in enumerate(series):
+        if crowd is None:
+            if center is None:
+                center = random.randint(0, len(weights))
+            crowd = spot(len(weights), center, width)
+            scale = magnitude * weights.sum()
+        if t < start:
+            yield weights
+        elif t < start + rise:
+            yield weights + scale * crowd * float(t - start + 1) / rise
+        else:
+            yield weights + scale * crowd * 0.5 ** ((t - start - rise + 1) / float(halfLife))
+
+# Integer leaf counts totalling total, drawn in proportion to weights
+def sampleCounts(weights, total, seed=None):
+    random = randomState(seed)
+    weights = np.asarray(weights, dtype=float)
+    return random.multinomial(total, weights / weights.sum()).astype(np.int64)
+
+# n client addresses (uint32) in space, with prefixes drawn in proportion
+# to weights and the host bits below them uniformly. Unshuffled traces
+# come out sorted by prefix, which is all counting needs.
+def sampleIPs(weights, n, space='10.2.0.0/16', shuffle=True, seed=None):
+    random = randomState(seed)
+    levels = len(weights).bit_length() - 1
+    assert len(weights) == 2 ** levels
+    (base, base_len) = space.split('/')
+    hostBits = 32 - int(base_len) - levels
+    assert hostBits >= 0
+
+    counts = sampleCounts(weights, n, random)
+    leaves = np.repeat(np.arange(len(weights), dtype=np.uint32), counts)
+    ips = np.uint32(ipToInt(base)) | (leaves << np.uint32(hostBits))
+    if hostBits > 0:
+        ips |= random.randint(0, 2 ** hostBits, n).astype(np.uint32)
+    if shuffle:
+        random.shuffle(ips)
+    return ips
+
+# Yields a trace per step of a sequence of weights, rate addresses per
+# unit of weight (so per step on average for weights summing to 1)
+def sampleSteps(series, rate, space='10.2.0.0/16', seed=None):
+    random = randomState(seed)
+    for weights in series:
+        yield sampleIPs(weights, random.poisson(rate * weights.sum()), space, seed=random)
+
+OCTET_PAIRS = None
+
+# Writes addresses one dotted quad per line, as analyze.py and replay.py
+# read them
+def writeTrace(ips, output):
+    global OCTET_PAIRS
+    if OCTET_PAIRS is None:
+        OCTET_PAIRS = ['%d.%d' % divmod(i, 256) for i in range(2 ** 16)]
+    f = open(output, 'w')
+    for chunk in np.array_split(ips, max(len(ips) // 2 ** 20, 1)):
+        (hi, lo) = ((chunk >> 16).tolist(), (chunk & 0xffff).tolist())
+        f.write(''.join([OCTET_PAIRS[h] + '.' + OCTET_PAIRS[l] + '\n' for (h, l) in zip(hi, lo)]))
+    f.close()
+
+class ZipfTree(RandomTree):
+    '''
+    Random tree whose leaves split total counts by zipfWeights
+    '''
+
+    def __init__(self, levels=1, exponent=1.0, total=None, normal=None, seed=None):
+        self.exponent = exponent
+        self.total = total
+        RandomTree.__init__(self, levels=levels, normal=normal, seed=seed)
+
+    def leafWeights(self, numLeaves, random):
+        levels = numLeaves.bit_length() - 1
+        return sampleCounts(zipfWeights(levels, self.exponent, random), self.total or 50 * numLeaves, random)
+
+class HotspotTree(RandomTree):
+    '''
+    Random tree whose leaves split total counts by hotspotWeights
+    '''
+
+    def __init__(self, levels=1, spots=8, share=0.8, total=None, normal=None, seed=None):
+        (self.spots, self.share) = (spots, share)
+        self.total = total
+        RandomTree.__init__(self, levels=levels, normal=normal, seed=seed)
+
+    def leafWeights(self, numLeaves, random):
+        levels = numLeaves.bit_length() - 1
+        return sampleCounts(hotspotWeights(levels, self.spots, self.share, seed=random), self.total or 50 * numLeaves, random)
+
+# Weights of a named static population
+def population(name, levels, seed=None):
+    if name == 'uniform':
+        return uniformWeights(levels)
+    if name == 'zipf':
+        return zipfWeights(levels, seed=seed)
+    if name == 'hotspot':
+        return hotspotWeights(levels, seed=seed)
+    raise ValueError('Unknown workload: ' + name)
+
+# Weights over steps of a population under a named change over time
+def timeline(name, weights, steps, seed=None):
+    if name == 'static':
+        return (weights for t in range(steps))
+    if name == 'diurnal':
+        return diurnal(weights, steps)
+    if name == 'flash':
+        return flashCrowd((weights for t in range(steps)), steps // 3, width=len(weights) / 1024.0, seed=seed)
+    if name == 'both':
+        return flashCrowd(diurnal(weights, steps), steps // 3, width=len(weights) / 1024.0, seed=seed)
+    raise ValueError('Unknown timeline: ' + name)
+
+def main():
+    parser = OptionParser(usage='Usage: %prog [options]')
+    parser.add_option('-w', '--workload', type='string', action='store', dest='workload', default='zipf')
+    parser.add_option('-d', '--depth', type='int', action='store', dest='depth', default=16)
+    parser.add_option('-n', '--requests', type='int', action='store', dest='requests', default=1000000)
+    parser.add_option('-s', '--space', type='string', action='store', dest='space', default='10.2.0.0/16')
+    parser.add_option('-T', '--steps', type='int', action='store', dest='steps', default=0)
+    parser.add_option('-x', '--timeline', type='string', action='store', dest='timeline', default='diurnal')
+    parser.add_option('-S', '--seed', type='int', action='store', dest='seed')
+    parser.add_option('-o', '--output', type='string', action='store', dest='output', default='trace.txt')
+    (options, args) = parser.parse_args()
+    if options.depth + int(options.space.split('/')[1]) > 32:
+        parser.error('Depth does not fit in the client space')
+
+    random = randomState(options.seed)
+    start = time.time()
+    try:
+        weights = population(options.workload, options.depth, random)
+        if options.steps == 0:
+            traces = [(options.output, sampleIPs(weights, options.requests, options.space, seed=random))]
+        else:
+            series = timeline(options.timeline, weights, options.steps, random)
+            traces = [('%s.%d' % (options.output, t), ips) for (t, ips) in
+                      enumerate(sampleSteps(series, options.requests, options.space, random))]
+    except ValueError, e:
+        parser.error(str(e))
+    elapsed = time.time() - start
+
+    for (output, ips) in traces:
+        writeTrace(ips, output)
+    total = sum([len(ips) for (output, ips) in traces])
+    print 'Drew %d addresses in %.3fs (%.1fM/s) into %d file(s)' % (
+        total, elapsed, total / max(elapsed, 1e-9) / 1e6, len(traces))
+
+if __name__ == '__main__':
+    main()